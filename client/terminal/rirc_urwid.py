@@ -177,6 +177,11 @@ class RIRCClient(object):
             self._bootstrap = False
             if loop:
                 self._update_buffers()
+        elif self._worker.resynced():
+            # The new snapshot replaces what every buffer shows
+            for channel in self._channels.values():
+                channel.clear()
+            self._bootstrap = True
         else:
             for network, channel in self._wins:
                 key = network + "@" + channel
@@ -370,6 +375,15 @@ class Channel(object):
             self._highlight = re.compile(self._highlight)
     highlight = property(fget=_get_highlight, fset=_set_highlight)
 
+    def clear(self):
+        del self._gui_lines[:]
+        self._raw_lines = []
+        self._marker = None
+        self._marker_date = 0
+        self._has_notifications = False
+        self._notification_type = Channel.Normal
+        self._pending_msgs = 0
+
     def _init_gui(self):
         self._widget = urwid.Frame(body=self._gui_box,
                                    footer=self._footer,
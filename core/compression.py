@@ -0,0 +1,46 @@
+import zlib
+
+# Replies smaller than this are not worth compressing
+MIN_SIZE = 1024
+
+def accepted_encoding(request):
+    accepted = []
+    for token in (request.getHeader("accept-encoding") or "").split(","):
+        parts = [part.strip() for part in token.split(";")]
+        if "q=0" in parts[1:] or "q=0.0" in parts[1:]:
+            continue
+        accepted.append(parts[0].lower())
+    for encoding in ("gzip", "deflate"):
+        if encoding in accepted:
+            return encoding
+    return None
+
+def _compressor(encoding):
+    if encoding == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(6)
+
+def compress(request, content):
+    encoding = accepted_encoding(request)
+    request.setHeader("vary", "accept-encoding")
+    if encoding is None or len(content) < MIN_SIZE:
+        return content
+    compressor = _compressor(encoding)
+    request.setHeader("content-encoding", encoding)
+    return compressor.compress(content) + compressor.flush()
+
+# For responses written piece by piece, every piece is flushed so the
+# client can decode it as soon as it arrives
+class StreamCompressor(object):
+    def __init__(self, request):
+        self._compressor = None
+        encoding = accepted_encoding(request)
+        request.setHeader("vary", "accept-encoding")
+        if encoding is not None:
+            self._compressor = _compressor(encoding)
+            request.setHeader("content-encoding", encoding)
+
+    def compress(self, data):
+        if self._compressor is None:
+            return data
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
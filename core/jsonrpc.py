@@ -0,0 +1,128 @@
+from decimal import Decimal
+import xmlrpclib
+
+from twisted.web import resource, server
+from twisted.internet import defer
+from twisted.python import log
+
+from compression import compress
+
+try:
+    import simplejson as json
+except ImportError, e:
+    import json
+
+try:
+    import msgpack
+except ImportError, e:
+    msgpack = None
+
+MSGPACK_TYPE = "application/x-msgpack"
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INTERNAL_ERROR = -32603
+
+# JSON-RPC 2.0 front end for the same xmlrpc_* methods the XML-RPC
+# resource serves. Results are sent as they are instead of as JSON
+# strings wrapped in XML. Requests sent as application/x-msgpack are
+# answered in msgpack when the msgpack module is available.
+class JsonRpc(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, rpc):
+        resource.Resource.__init__(self)
+        self._rpc = rpc
+
+    def render_POST(self, request):
+        error = self._rpc.check_auth(request)
+        if error is not None:
+            return error
+
+        binary = msgpack is not None and \
+            (request.getHeader("content-type") or "").startswith(MSGPACK_TYPE)
+
+        request.content.seek(0, 0)
+        try:
+            if binary:
+                calls = msgpack.unpackb(request.content.read())
+            else:
+                calls = json.loads(request.content.read())
+        except Exception, e:
+            self._write(request, binary, self._error(None, PARSE_ERROR, str(e)))
+            return server.NOT_DONE_YET
+
+        if isinstance(calls, list):
+            pending = [self._call(call) for call in calls]
+            d = defer.gatherResults(pending)
+        else:
+            pending = [self._call(calls)]
+            d = pending[0]
+
+        # A client that goes away cancels its calls
+        responseFailed = []
+        def _responseFailed(reason):
+            responseFailed.append(reason)
+            for call in pending:
+                call.cancel()
+        request.notifyFinish().addErrback(_responseFailed)
+
+        def _respond(response):
+            if not responseFailed:
+                self._write(request, binary, response)
+        d.addCallback(_respond)
+        d.addErrback(log.err)
+        return server.NOT_DONE_YET
+
+    def _call(self, call):
+        if not isinstance(call, dict) or not "method" in call:
+            return defer.succeed(self._error(None, INVALID_REQUEST, "Invalid request"))
+
+        call_id = call.get("id")
+        try:
+            function = self._rpc.find_function(str(call["method"]))
+        except xmlrpclib.Fault, f:
+            return defer.succeed(self._error(call_id, METHOD_NOT_FOUND, f.faultString))
+
+        params = call.get("params", [])
+        if isinstance(params, dict):
+            d = defer.maybeDeferred(function, **dict([(str(k), v) for k, v in params.items()]))
+        else:
+            d = defer.maybeDeferred(function, *params)
+        d.addCallbacks(lambda result: {"jsonrpc": "2.0",
+                                       "result": result,
+                                       "id": call_id},
+                       lambda failure: self._failed(call_id, failure))
+        return d
+
+    def _failed(self, call_id, failure):
+        if failure.check(defer.CancelledError):
+            return self._error(call_id, INTERNAL_ERROR, "Cancelled")
+        if failure.check(xmlrpclib.Fault):
+            return self._error(call_id, failure.value.faultCode,
+                               failure.value.faultString)
+        log.err(failure)
+        return self._error(call_id, INTERNAL_ERROR, failure.getErrorMessage())
+
+    def _error(self, call_id, code, message):
+        return {"jsonrpc": "2.0",
+                "error": {"code": code, "message": message},
+                "id": call_id}
+
+    def _write(self, request, binary, response):
+        if binary:
+            content = msgpack.packb(response, default=_msgpack_default)
+            request.setHeader("content-type", MSGPACK_TYPE)
+        else:
+            content = json.dumps(response)
+            request.setHeader("content-type", "application/json")
+        content = compress(request, content)
+        request.setHeader("content-length", str(len(content)))
+        request.write(content)
+        request.finish()
+
+def _msgpack_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError("Can't encode %r" % (obj,))
@@ -2,16 +2,26 @@ from twisted.words.protocols import irc
 from twisted.internet import protocol, reactor, ssl
 from twisted.internet.task import LoopingCall
 
+import random
+import re
 import time
 
 networks = {}
 
 from sqliter import SQLiter
 from diff_consts import Diff
+from roster import Roster
+
+# Servers quit everyone behind a split with "left.server right.server"
+NETSPLIT = re.compile(r"^[\w-]+(\.[\w-]+)+ [\w-]+(\.[\w-]+)+$")
 
 class RIRCProtocol(irc.IRCClient):
+    # Seconds netsplit quits are collected before they are written
+    SPLIT_DELAY = 2
+
     def __init__(self):
         self._starting_query = {}
+        self._splits = {}
         self._ping_lc = LoopingCall(self._self_heartbeat)
         self._host = ""
 
@@ -48,7 +58,14 @@ class RIRCProtocol(irc.IRCClient):
         print "Should bounce to:", info
         self.factory.url = info
 
+    def connectionLost(self, reason):
+        if self._ping_lc.running:
+            self._ping_lc.stop()
+        irc.IRCClient.connectionLost(self, reason)
+
     def signedOn(self):
+        self.factory.signed_on()
+        self.factory.network.roster.clear()
         for channel in self.factory.network.channels:
             self.join(channel)
         print "Signed on as %s." % (self.nickname,)
@@ -56,41 +73,82 @@ class RIRCProtocol(irc.IRCClient):
     def privmsg(self, user, channel, msg):
         user_str = user
         channel_str = channel
+        mention = self.factory.network.match_mention(msg)
         if channel == self.nickname:
             user_str = user
             channel_str = user
+            # Every query line is for us
+            if mention is None:
+                mention = self.nickname
         self.factory.db.add_line(time.time(),
                                  self.factory.network.name,
                                  channel_str,
                                  user_str,
-                                 msg)
+                                 msg,
+                                 mention)
 
     def noticed(self, user, channel, message):
         pass
 
+    def isupport(self, options):
+        self.factory.network.roster.set_prefixes(self.supported.getFeature("PREFIX"))
+
     def modeChanged(self, user, channel, set, modes, args):
-        pass
+        # Only member prefix modes matter to the roster
+        for mode, arg in zip(modes, args):
+            if arg is not None:
+                self.factory.network.roster.set_mode(channel, arg, mode, set)
 
     def pong(self, user, secs):
         pass
 
     def kickedFrom(self, channel, kicker, message):
-        pass
+        self.factory.network.roster.drop(channel)
 
     def nickChanged(self, nick):
         pass
 
     def userQuit(self, user, quitMessage):
-        channels = self.factory.db.get_channels(self.factory.network.name)
-        for channel in channels:
-            self.factory.db.add_line(time.time(),
-                                     self.factory.network.name,
-                                     channel,
-                                     "-",
-                                     "<== %s (%s)" % (user, quitMessage))
+        # Only the channels user was in get the quit
+        channels = self.factory.network.roster.quit(user)
+        if len(channels) == 0:
+            return
+
+        if NETSPLIT.match(quitMessage) is not None:
+            if not quitMessage in self._splits:
+                self._splits[quitMessage] = ([], {})
+                reactor.callLater(self.SPLIT_DELAY, self._record_split, quitMessage)
+            order, quits = self._splits[quitMessage]
+            for channel in channels:
+                if not channel in quits:
+                    order.append(channel)
+                    quits[channel] = []
+                quits[channel].append(user)
+            return
+
+        now = time.time()
+        self.factory.db.add_lines([(now,
+                                    self.factory.network.name,
+                                    channel,
+                                    "-",
+                                    "<== %s (%s)" % (user, quitMessage),
+                                    None) for channel in channels])
+
+    def _record_split(self, servers):
+        # One line per channel for the whole split, in one transaction
+        order, quits = self._splits.pop(servers)
+        left, right = servers.split(" ")
+        now = time.time()
+        self.factory.db.add_lines([(now,
+                                    self.factory.network.name,
+                                    channel,
+                                    "-",
+                                    "<== Netsplit %s <-> %s: %s" % (left, right,
+                                                                   ", ".join(quits[channel])),
+                                    None) for channel in order])
 
     def userKicked(self, kickee, channel, kicker, message):
-        pass
+        self.factory.network.roster.part(channel, kickee)
 
     def action(self, user, channel, data):
         pass
@@ -105,7 +163,7 @@ class RIRCProtocol(irc.IRCClient):
                                  "(%s) Topic is: %s" % (user, newTopic))
 
     def userRenamed(self, oldname, newname):
-        pass
+        self.factory.network.roster.rename(oldname, newname)
 
     def receivedMOTD(self, motd):
         self._add_network_msg(motd)
@@ -121,8 +179,11 @@ class RIRCProtocol(irc.IRCClient):
         print "Pong from %s :: %s" % (prefix, ", ".join(params))
 
     def irc_RPL_WHOISUSER(self, prefix, params):
+        d = self.factory.db.get_channels(self.factory.network.name)
+        d.addCallback(self._start_query, params)
+
+    def _start_query(self, channels, params):
         user = params[1]
-        channels = self.factory.db.get_channels(self.factory.network.name)
         if user in self._starting_query.keys() and \
                 self._starting_query[user] and \
                 not user in channels:
@@ -133,15 +194,23 @@ class RIRCProtocol(irc.IRCClient):
                                      "*** Starting query with %s ***" % (params[1]))
 
     def irc_RPL_NAMREPLY(self, prefix, params):
+        self.factory.network.roster.add_names(params[2], params[3].split())
         self.factory.db.add_line(time.time(),
                                  self.factory.network.name,
                                  params[2],
                                  "-",
                                  ", ".join(params[3].split(" ")))
 
+    def irc_RPL_ENDOFNAMES(self, prefix, params):
+        self.factory.network.roster.end_names(params[1])
+
     def irc_JOIN(self, prefix, params):
         print "JOIN", prefix, params
         self.factory.network.set_channel_enabled(params[0])
+        if prefix.split("!")[0] == self.factory.network.nick:
+            # NAMES follows and fills the channel in
+            self.factory.network.roster.drop(params[0])
+        self.factory.network.roster.join(params[0], prefix.split("!")[0])
         now = time.time()
         self.factory.db.add_line(now,
                                  self.factory.network.name,
@@ -159,7 +228,10 @@ class RIRCProtocol(irc.IRCClient):
         msg = ""
         if prefix.split("!")[0] == self.factory.network.nick:
             self.factory.network.set_channel_enabled(params[0], False)
+            self.factory.network.roster.drop(params[0])
             msg = self.factory.network.leave_reason
+        else:
+            self.factory.network.roster.part(params[0], prefix.split("!")[0])
         if len(params) > 1:
             msg = params[1]
         self.factory.db.add_line(time.time(),
@@ -193,12 +265,20 @@ class RIRCProtocol(irc.IRCClient):
                 return
         self.factory.db.close(self.factory.network.name, channel)
 
-class RIRCFactory(protocol.ClientFactory):
+# Reconnects with a delay that grows by factor (with some jitter) after
+# every failed attempt, up to maxDelay seconds, and starts over once the
+# server lets us sign on
+class RIRCFactory(protocol.ReconnectingClientFactory):
     protocol = RIRCProtocol
 
-    def __init__(self, network, db):
+    def __init__(self, network, db, max_delay = 300):
         self._network = network
         self._db = db
+        self.maxDelay = max_delay
+        self._state = "waiting"
+        self._since = time.time()
+        self._next_attempt = 0
+        self._last_error = ""
 
     def _get_db(self):
         return self._db
@@ -208,22 +288,75 @@ class RIRCFactory(protocol.ClientFactory):
         return self._network
     network = property(_get_network_name)
 
+    def _set_state(self, state):
+        self._state = state
+        self._since = time.time()
+        self._next_attempt = 0
+
+    def wait(self, delay):
+        self._set_state("waiting")
+        self._next_attempt = time.time() + delay
+
+    def state(self):
+        return {"state": self._state,
+                "since": self._since,
+                "retries": self.retries,
+                "next_attempt": self._next_attempt,
+                "last_error": self._last_error}
+
+    def startedConnecting(self, connector):
+        self._set_state("connecting")
+
     def buildProtocol(self, addr):
         print 'Building IRC protocol...'
+        self._set_state("registering")
         p = protocol.ClientFactory.buildProtocol(self, addr)
         p.factory = self
         p.factory.network.protocol = p
         return p
 
+    def signed_on(self):
+        self.resetDelay()
+        self._set_state("connected")
+
+    def retry(self, connector = None):
+        # ReconnectingClientFactory.retry adds the jitter after capping
+        # the delay, here the delay never goes past maxDelay
+        if not self.continueTrying:
+            return
+        if connector is None:
+            connector = self.connector
+        self.retries += 1
+        self.delay = min(self.delay * self.factor, self.maxDelay)
+        if self.jitter:
+            self.delay = random.normalvariate(self.delay, self.delay * self.jitter)
+            self.delay = max(0, min(self.delay, self.maxDelay))
+
+        def reconnector():
+            self._callID = None
+            connector.connect()
+        self._callID = reactor.callLater(self.delay, reconnector)
+
+    def _retry(self, connector, reason):
+        self._last_error = reason.getErrorMessage()
+        self.retry(connector)
+        if self.continueTrying:
+            self.wait(self.delay)
+            print "Reconnecting to %s in %.1f seconds." % (self._network.name, self.delay)
+        else:
+            self._set_state("disconnected")
+
     def clientConnectionLost(self, connector, reason):
-        print "Lost connection (%s), reconnecting." % (reason,)
-        connector.connect()
+        print "Lost connection (%s)." % (reason,)
+        self._retry(connector, reason)
 
     def clientConnectionFailed(self, connector, reason):
         print "Could not connect: %s" % (reason,)
+        self._retry(connector, reason)
 
 class Network(object):
-    def __init__(self, db, name, use_ssl, port, url, channels = [], nicks = [], leave_reason = ""):
+    def __init__(self, db, name, use_ssl, port, url, channels = [], nicks = [], leave_reason = "",
+                 highlights = [], connect_delay = 0, max_delay = 300):
         object.__init__(self)
 
         self._name = name
@@ -237,16 +370,26 @@ class Network(object):
         self._umodes = ""
         self._cmodes = ""
         self._leave_reason = leave_reason
+        self._highlights = highlights
+        self._mention_re = None
+        self._mention_nick = None
 
         self._protocol = None
         self._db = db
 
         self._topics = {}
+        self._roster = Roster()
+
+        # Networks don't all connect at the same moment
+        self._factory = RIRCFactory(self, db, max_delay)
+        self._factory.wait(connect_delay)
+        reactor.callLater(connect_delay, self._connect)
 
+    def _connect(self):
         if self._ssl:
-            reactor.connectSSL(url, port, RIRCFactory(self, db), ssl.ClientContextFactory())
+            reactor.connectSSL(self._url, self._port, self._factory, ssl.ClientContextFactory())
         else:
-            reactor.connectTCP(url, port, RIRCFactory(self, db))
+            reactor.connectTCP(self._url, self._port, self._factory)
 
     def _get_name(self):
         return self._name
@@ -296,6 +439,33 @@ class Network(object):
         return self._nicks[self._nick_index]
     nick = property(fget=_get_nick)
 
+    def _get_highlights(self):
+        return self._highlights
+    def _set_highlights(self, highlights):
+        self._highlights = highlights
+        self._mention_re = None
+    highlights = property(fget=_get_highlights, fset=_set_highlights)
+
+    def match_mention(self, msg):
+        # Returns the nick or keyword msg mentions, or None. The regex is
+        # only rebuilt when the nick or the keywords change.
+        keywords = [self.nick] + [keyword for keyword in self._highlights if keyword]
+        if self._mention_re is None or self._mention_nick != self.nick:
+            self._mention_nick = self.nick
+            self._mention_re = re.compile("|".join([r"(?<!\w)(%s)(?!\w)" % (re.escape(keyword),)
+                                                    for keyword in keywords]), re.I)
+        match = self._mention_re.search(msg)
+        if match is None:
+            return None
+        return keywords[match.lastindex - 1]
+
+    def connection_state(self):
+        return self._factory.state()
+
+    def _get_roster(self):
+        return self._roster
+    roster = property(_get_roster)
+
     def get_topic(self, chan):
         if not chan in self._topics:
             return ""
@@ -380,6 +550,8 @@ class Network(object):
     def close(self, channel):
         self.protocol.close(channel)
 
-def add_network(db, name, use_ssl, port, url, channels = [], nicks = [], leave_reason = ""):
+def add_network(db, name, use_ssl, port, url, channels = [], nicks = [], leave_reason = "",
+                highlights = [], connect_delay = 0, max_delay = 300):
     global networks
-    networks[name] = Network(db, name, use_ssl, port, url, channels, nicks, leave_reason)
+    networks[name] = Network(db, name, use_ssl, port, url, channels, nicks, leave_reason,
+                             highlights, connect_delay, max_delay)
@@ -1,8 +1,12 @@
-from twisted.web import xmlrpc, server, http
+from twisted.web import xmlrpc, server, http, resource
 from twisted.words.protocols import irc
 from twisted.internet import protocol, defer, reactor, ssl
+from twisted.internet.task import LoopingCall
+from twisted.python import log
 
 import sys
+import base64
+import random
 
 from ConfigParser import ConfigParser
 from os import path
@@ -13,37 +17,106 @@ except ImportError, e:
 
 from xmlrpcauth import XmlRpcAuth
 from sqliter import SQLiter
+from storage import Storage
+from tailcache import TailCache
 from network import add_network, networks
+from stream import DiffStream
+from jsonrpc import JsonRpc
 
 class RIRC(XmlRpcAuth):
+    # Longest a wait_changes call is held before answering
+    MAX_WAIT = 300
+    # Most lines per channel a get_snapshot call returns
+    MAX_SNAPSHOT_LINES = 1000
+
+    # Lines indexed per run of the full text backfill
+    FTS_BACKFILL_CHUNK = 5000
+    # Most hits a search call returns
+    MAX_SEARCH_HITS = 200
+    # Most mentions a get_mentions call returns
+    MAX_MENTIONS = 200
+
+    UNKNOWN_SUBSCRIPTION = 404
+    SEARCH_UNAVAILABLE = 501
+
     def __init__(self, datadir = "datadir", user = "", password = ""):
         XmlRpcAuth.__init__(self, user, password)
 
         self._leave_reason = ""
         self._datadir = datadir
-        self._db = SQLiter(self._datadir)
+        self._db = None
         self._port = 0
+        self._batch_size = 200
+        self._batch_delay = 0.05
+        self._read_pool_size = 3
+        self._synchronous = "normal"
+        self._cache_size = -8000
+        self._mmap_size = 0
+        self._tail_cache_lines = 400
+        self._tail_cache_max_lines = 50000
+        self._diff_horizon = 7 * 24 * 3600
+        self._compact_interval = 3600
+        self._archive_age = 0
+        # Lines older than max_age seconds or past the newest max_lines of
+        # their channel are pruned, 0 is no limit
+        self._max_age = 0
+        self._max_lines = 0
+        self._retention = {}
+        self._prune_interval = 60
+        self._highlights = []
+        # Networks connect at random times within the first connect_window
+        # seconds, and wait at most reconnect_max_delay between attempts
+        self._connect_window = 10
+        self._reconnect_max_delay = 300
         self.loadConfig(path.join(self._datadir,
                                   "rirc.cfg"))
 
+    def encode_result(self, result):
+        # Structured results travel as JSON strings over XML-RPC
+        if isinstance(result, dict):
+            return json.dumps(result)
+        return result
+
     def _get_port(self):
         return self._port
     port = property(_get_port)
 
+    def _get_db(self):
+        return self._db
+    db = property(_get_db)
+
     def loadConfig(self, path):
         self.config = ConfigParser()
         self.config.read([path])
 
+        if self.config.has_section("General"):
+            self._load_general("General")
+
+        self._db = Storage(SQLiter(self._datadir, self._batch_size, self._batch_delay,
+                                   self._read_pool_size, self._synchronous,
+                                   self._cache_size, self._mmap_size),
+                           cache=TailCache(self._tail_cache_lines,
+                                           self._tail_cache_max_lines))
+        reactor.addSystemEventTrigger("before", "shutdown", self._db.stop)
+        self._compact_lc = LoopingCall(self._compact)
+        self._compact_lc.start(self._compact_interval)
+        # Lines from before the search index existed are indexed a chunk
+        # at a time, in between the regular writes
+        self._backfill_lc = LoopingCall(self._backfill)
+        if self._db.fts:
+            self._backfill_lc.start(1)
+        self._prune_lc = LoopingCall(self._prune)
+        self._prune_lc.start(self._prune_interval)
+
         for section in self.config.sections():
             if section == "General":
-                self._port = self.config.getint(section, "ServePort")
-                self._auth = self.config.getboolean(section, "UseAuth")
-                if(self._auth):
-                    self._user = self.config.get(section, "User")
-                    self._password = self.config.get(section, "Password")
-                self._leave_reason = self.config.get(section, "LeaveReason")
                 continue
 
+            self._load_retention(section)
+            highlights = self._highlights
+            if self.config.has_option(section, "Highlights"):
+                highlights = highlights + self._split_list(self.config.get(section, "Highlights"))
+
             add_network(self._db,
                         name     = section,
                         use_ssl  = self.config.getboolean(section, "SSL"),
@@ -51,7 +124,108 @@ class RIRC(XmlRpcAuth):
                         port     = self.config.getint(section, "Port"),
                         channels = self.config.get(section, "AutoJoin").split(","),
                         nicks    = self.config.get(section, "Nicks").split(","),
-                        leave_reason = self._leave_reason)
+                        leave_reason = self._leave_reason,
+                        highlights = highlights,
+                        connect_delay = random.uniform(0, self._connect_window),
+                        max_delay = self._reconnect_max_delay)
+
+    def _load_retention(self, section):
+        retention = {None: (self._max_age, self._max_lines)}
+        if self.config.has_option(section, "MaxAge"):
+            retention[None] = (self.config.getint(section, "MaxAge"), retention[None][1])
+        if self.config.has_option(section, "MaxLines"):
+            retention[None] = (retention[None][0], self.config.getint(section, "MaxLines"))
+        # ChannelRetention=#channel:max_age:max_lines,...
+        if self.config.has_option(section, "ChannelRetention"):
+            for item in self._split_list(self.config.get(section, "ChannelRetention")):
+                channel, max_age, max_lines = item.rsplit(":", 2)
+                retention[channel.lower()] = (int(max_age or 0), int(max_lines or 0))
+        self._retention[section] = retention
+
+    def retention(self, network, channel):
+        if not network in self._retention:
+            return self._max_age, self._max_lines
+        retention = self._retention[network]
+        return retention.get(channel.lower(), retention[None])
+
+    def _split_list(self, value):
+        return [item.strip() for item in value.split(",") if item.strip()]
+
+    def _load_general(self, section):
+        self._port = self.config.getint(section, "ServePort")
+        self._auth = self.config.getboolean(section, "UseAuth")
+        if(self._auth):
+            self._user = self.config.get(section, "User")
+            self._password = self.config.get(section, "Password")
+        self._leave_reason = self.config.get(section, "LeaveReason")
+        if self.config.has_option(section, "BatchSize"):
+            self._batch_size = self.config.getint(section, "BatchSize")
+        if self.config.has_option(section, "BatchDelay"):
+            self._batch_delay = self.config.getfloat(section, "BatchDelay")
+        if self.config.has_option(section, "ReadPoolSize"):
+            self._read_pool_size = max(1, self.config.getint(section, "ReadPoolSize"))
+        if self.config.has_option(section, "Synchronous"):
+            self._synchronous = self.config.get(section, "Synchronous").lower()
+            if not self._synchronous in ("off", "normal", "full", "extra"):
+                raise ValueError("Synchronous must be off, normal, full or extra")
+        if self.config.has_option(section, "CacheSize"):
+            self._cache_size = self.config.getint(section, "CacheSize")
+        if self.config.has_option(section, "MmapSize"):
+            self._mmap_size = self.config.getint(section, "MmapSize")
+        if self.config.has_option(section, "TailCacheLines"):
+            self._tail_cache_lines = self.config.getint(section, "TailCacheLines")
+        if self.config.has_option(section, "TailCacheMaxLines"):
+            self._tail_cache_max_lines = self.config.getint(section, "TailCacheMaxLines")
+        if self.config.has_option(section, "DiffHorizon"):
+            self._diff_horizon = self.config.getint(section, "DiffHorizon")
+        if self.config.has_option(section, "CompactInterval"):
+            self._compact_interval = self.config.getint(section, "CompactInterval")
+        if self.config.has_option(section, "MaxAge"):
+            self._max_age = self.config.getint(section, "MaxAge")
+        if self.config.has_option(section, "MaxLines"):
+            self._max_lines = self.config.getint(section, "MaxLines")
+        if self.config.has_option(section, "PruneInterval"):
+            self._prune_interval = self.config.getint(section, "PruneInterval")
+        if self.config.has_option(section, "ArchiveAge"):
+            self._archive_age = self.config.getint(section, "ArchiveAge")
+        if self.config.has_option(section, "Highlights"):
+            self._highlights = self._split_list(self.config.get(section, "Highlights"))
+        if self.config.has_option(section, "ConnectWindow"):
+            self._connect_window = max(0, self.config.getfloat(section, "ConnectWindow"))
+        if self.config.has_option(section, "ReconnectMaxDelay"):
+            self._reconnect_max_delay = max(1, self.config.getint(section, "ReconnectMaxDelay"))
+
+    def _compact(self):
+        d = self._db.compact_diffs(self._diff_horizon)
+        if self._archive_age > 0:
+            d.addCallback(lambda _: self._archive())
+        d.addErrback(log.err)
+
+    def _archive(self):
+        # A chunk at a time, so lines keep being written in between
+        def _moved(moved):
+            if moved > 0:
+                return self._archive()
+        return self._db.archive(self._archive_age).addCallback(_moved)
+
+    def _prune(self):
+        # One small batch per write, until there is nothing left to delete
+        def _pruned(deleted):
+            if deleted > 0:
+                return self._db.prune(self.retention).addCallback(_pruned)
+        d = self._db.prune(self.retention)
+        d.addCallback(_pruned)
+        d.addErrback(log.err)
+        return d
+
+    def _backfill(self):
+        def _done(remaining):
+            if remaining == 0 and self._backfill_lc.running:
+                print "DB: Search index is complete"
+                self._backfill_lc.stop()
+        d = self._db.backfill_fts(self.FTS_BACKFILL_CHUNK)
+        d.addCallbacks(_done, log.err)
+        return d
 
     def xmlrpc_join(self, network, channel, key=None):
         global networks
@@ -152,18 +326,32 @@ class RIRC(XmlRpcAuth):
 
     def xmlrpc_get_networks(self):
         print "Getting networks..."
-        return json.dumps({"networks": self._db.get_networks()})
+        d = self._db.get_networks()
+        d.addCallback(lambda nets: {"networks": nets})
+        return d
 
     def xmlrpc_get_channels(self, network):
-        return json.dumps({"network": network,
-                           "channels": self._db.get_channels(network)})
+        d = self._db.get_channels(network)
+        d.addCallback(lambda channels: {"network": network,
+                                        "channels": channels})
+        return d
 
     def xmlrpc_get_lines(self, network, channel, offset, count, older_than = -1):
-        return json.dumps({"network": network,
-                           "channel": channel,
-                           "lines": self._db.get_lines(network, channel,
-                                                       offset, count,
-                                                       older_than)})
+        d = self._db.get_lines(network, channel, offset, count, older_than)
+        d.addCallback(lambda lines: {"network": network,
+                                     "channel": channel,
+                                     "lines": lines})
+        return d
+
+    def xmlrpc_get_page(self, network, channel, cursor, count, older = True):
+        def _page((lines, next_cursor, prev_cursor)):
+            return {"network": network,
+                    "channel": channel,
+                    "lines": lines,
+                    "next_cursor": next_cursor,
+                    "prev_cursor": prev_cursor}
+        d = self._db.get_page(network, channel, cursor, count, older)
+        return d.addCallback(_page)
 
     def xmlrpc_nick(self, network):
         global networks
@@ -171,17 +359,139 @@ class RIRC(XmlRpcAuth):
             return networks[network].nick
 
     def xmlrpc_get_diffs(self, since):
-        diffs, now = self._db.get_diffs(since)
-        return json.dumps({"changes": diffs,
-                           "timestamp": now})
+        def _diffs((diffs, now, resync)):
+            return {"changes": diffs,
+                    "timestamp": now,
+                    "resync": resync}
+        return self._db.get_diffs(since).addCallback(_diffs)
+
+    def _changes(self, result):
+        changes, next_cursor, resync = result
+        return {"changes": changes,
+                "next_cursor": next_cursor,
+                "resync": resync}
+
+    def get_subscription(self, subscription):
+        if subscription is None or subscription == "":
+            return None
+        try:
+            key = str(subscription)
+            filters = json.loads(base64.urlsafe_b64decode(key + "=" * (-len(key) % 4)))
+            return {"networks": list(filters["networks"]),
+                    "channels": [tuple(channel) for channel in filters["channels"]],
+                    "cmds": list(filters["cmds"])}
+        except Exception:
+            raise xmlrpc.Fault(self.UNKNOWN_SUBSCRIPTION,
+                               "Unknown subscription %s" % (subscription,))
+
+    def xmlrpc_subscribe(self, networks = [], channels = [], cmds = []):
+        # The id is the filter itself, so the core keeps no state for it:
+        # ids are shared by every client with the same filter and still
+        # work after a restart
+        subscription = {"networks": sorted(set(networks)),
+                        "channels": sorted(set([tuple(channel) for channel in channels])),
+                        "cmds": sorted(set(cmds))}
+        key = json.dumps(subscription, sort_keys=True, separators=(",", ":"))
+        return base64.urlsafe_b64encode(key).rstrip("=")
+
+    def xmlrpc_unsubscribe(self, subscription):
+        # Nothing to forget, kept for older clients
+        pass
+
+    def xmlrpc_get_changes(self, cursor, subscription = None):
+        subscription = self.get_subscription(subscription)
+        d = self._db.get_changes(cursor, subscription=subscription)
+        return d.addCallback(self._changes)
+
+    def xmlrpc_wait_changes(self, cursor, timeout = 60, subscription = None):
+        subscription = self.get_subscription(subscription)
+        timeout = max(0, min(timeout, self.MAX_WAIT))
+        d = self._db.wait_changes(cursor, timeout, subscription=subscription)
+        return d.addCallback(self._changes)
 
     def xmlrpc_mark(self, date, network, channel):
-        self._db.mark(date, network, channel)
+        return self._db.mark(date, network, channel)
 
     def xmlrpc_get_mark(self, network, channel):
-        return json.dumps({"network": network,
-                           "channel": channel,
-                           "marker": self._db.get_mark(network, channel)})
+        d = self._db.get_mark(network, channel)
+        d.addCallback(lambda mark: {"network": network,
+                                    "channel": channel,
+                                    "marker": mark})
+        return d
+
+    def xmlrpc_get_unread(self, network = None, channel = None, count = 400):
+        def _unread((counts, lines)):
+            return {"counts": counts,
+                    "network": network,
+                    "channel": channel,
+                    "lines": lines}
+        return self._db.get_unread(network, channel, count).addCallback(_unread)
+
+    def xmlrpc_get_mentions(self, cursor = None, count = 50, network = None):
+        def _mentions((mentions, next_cursor)):
+            return {"mentions": mentions,
+                    "next_cursor": next_cursor}
+        count = max(0, min(count, self.MAX_MENTIONS))
+        return self._db.get_mentions(cursor, count, network).addCallback(_mentions)
+
+    def xmlrpc_search(self, query, network = None, channel = None, cursor = None, count = 50):
+        def _search((hits, next_cursor)):
+            return {"query": query,
+                    "hits": hits,
+                    "next_cursor": next_cursor}
+        if not self._db.fts:
+            raise xmlrpc.Fault(self.SEARCH_UNAVAILABLE,
+                               "Full text search is not available")
+        count = max(0, min(count, self.MAX_SEARCH_HITS))
+        return self._db.search(query, network, channel, cursor, count).addCallback(_search)
+
+    def xmlrpc_get_names(self, network, channel, prefix = None):
+        global networks
+        names = []
+        if network in networks.keys():
+            names = networks[network].roster.names(channel, prefix)
+        return {"network": network,
+                "channel": channel,
+                "names": names}
+
+    def xmlrpc_get_connections(self, network = None):
+        global networks
+        names = networks.keys()
+        if network is not None:
+            names = [name for name in names if name == network]
+        return {"networks": dict([(name, networks[name].connection_state())
+                                  for name in names])}
+
+    def xmlrpc_get_cache_stats(self):
+        return self._db.get_cache_stats()
+
+    def xmlrpc_backup(self):
+        return self._db.backup().addCallback(lambda backup_file: {"path": backup_file})
+
+    def xmlrpc_get_snapshot(self, count = 400):
+        global networks
+        def _snapshot(snapshot):
+            snapshot["nicks"] = {}
+            snapshot["topics"] = {}
+            for network in snapshot["networks"]:
+                if network in networks.keys():
+                    snapshot["nicks"][network] = networks[network].nick
+                    snapshot["topics"][network] = dict([(channel, networks[network].get_topic(channel))
+                                                        for channel in snapshot["channels"][network]])
+            return snapshot
+        count = max(0, min(count, self.MAX_SNAPSHOT_LINES))
+        return self._db.get_snapshot(count).addCallback(_snapshot)
+
+class RIRCRoot(resource.Resource):
+    def __init__(self, rpc):
+        resource.Resource.__init__(self)
+        self._rpc = rpc
+        self.putChild("stream", DiffStream(rpc, rpc.db))
+        self.putChild("json", JsonRpc(rpc))
+
+    def getChild(self, name, request):
+        # Every other path is XML-RPC, as it has always been
+        return self._rpc
 
 if __name__ == "__main__":
     datadir = sys.argv[1]
@@ -189,5 +499,5 @@ if __name__ == "__main__":
     priv = path.join(datadir, "rirc_priv.pem")
     s = RIRC(datadir=datadir)
     sslContext = ssl.DefaultOpenSSLContextFactory(priv, cert)
-    reactor.listenSSL(s.port, server.Site(s), sslContext)
+    reactor.listenSSL(s.port, server.Site(RIRCRoot(s)), sslContext)
     reactor.run()
@@ -0,0 +1,178 @@
+from bisect import bisect_left
+
+# Who is in which channel of a network, built from NAMES, JOIN, PART,
+# KICK, NICK, QUIT and MODE. Channels and nicks are compared case
+# insensitively but keep the case the server sent.
+#
+# Big channels are the common case, so members are kept small: every nick
+# is one User shared by all its channels, channels map the interned
+# lowercase nick to an int of mode prefix bits, and the sorted nick list
+# used for prefix lookups is only rebuilt when someone asks for it.
+
+class User(object):
+    __slots__ = ("nick", "channels")
+
+    def __init__(self, nick):
+        self.nick = nick
+        self.channels = 0
+
+class Channel(object):
+    __slots__ = ("name", "members", "keys")
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}
+        self.keys = None
+
+class Roster(object):
+    def __init__(self):
+        self._users = {}
+        self._channels = {}
+        self._names = {}
+        self.set_prefixes({"o": ("@", 0), "v": ("+", 1)})
+
+    def set_prefixes(self, prefixes):
+        # prefixes as in ServerSupportedFeatures: mode -> (symbol, priority)
+        self._mode_bits = {}
+        self._symbol_bits = {}
+        self._symbols = []
+        for mode, (symbol, priority) in prefixes.items():
+            self._mode_bits[mode] = 1 << priority
+            self._symbol_bits[symbol] = 1 << priority
+            self._symbols.append((priority, symbol))
+        self._symbols = [(1 << priority, symbol) for priority, symbol in sorted(self._symbols)]
+
+    def _key(self, name):
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        return intern(name.lower())
+
+    def _prefixes(self, flags):
+        return "".join([symbol for bit, symbol in self._symbols if flags & bit])
+
+    def _add(self, channel, nick, flags = 0):
+        key = self._key(nick)
+        user = self._users.get(key)
+        if user is None:
+            user = User(intern(nick))
+            self._users[key] = user
+        if not key in channel.members:
+            user.channels += 1
+            channel.keys = None
+        channel.members[key] = flags
+
+    def _remove(self, channel, key):
+        if channel.members.pop(key, None) is None:
+            return False
+        channel.keys = None
+        user = self._users[key]
+        user.channels -= 1
+        if user.channels == 0:
+            del self._users[key]
+        return True
+
+    def _release(self, channel):
+        for key in channel.members.keys():
+            self._remove(channel, key)
+
+    def add_names(self, channel, nicks):
+        # RPL_NAMREPLY, a channel's list comes in several replies and only
+        # replaces the current one at RPL_ENDOFNAMES
+        names = self._names.get(self._key(channel))
+        if names is None:
+            names = Channel(channel)
+            self._names[self._key(channel)] = names
+        for nick in nicks:
+            flags = 0
+            while len(nick) > 0 and nick[0] in self._symbol_bits:
+                flags |= self._symbol_bits[nick[0]]
+                nick = nick[1:]
+            self._add(names, nick, flags)
+
+    def end_names(self, channel):
+        names = self._names.pop(self._key(channel), None)
+        if names is None:
+            return
+        old = self._channels.get(self._key(channel))
+        if old is not None:
+            self._release(old)
+        self._channels[self._key(channel)] = names
+
+    def join(self, channel, nick):
+        key = self._key(channel)
+        if not key in self._channels:
+            self._channels[key] = Channel(channel)
+        self._add(self._channels[key], nick)
+
+    def part(self, channel, nick):
+        channel = self._channels.get(self._key(channel))
+        if channel is not None:
+            self._remove(channel, self._key(nick))
+
+    def set_mode(self, channel, nick, mode, on):
+        # Returns False for modes that aren't member prefixes
+        bit = self._mode_bits.get(mode)
+        if bit is None:
+            return False
+        channel = self._channels.get(self._key(channel))
+        key = self._key(nick)
+        if channel is not None and key in channel.members:
+            if on:
+                channel.members[key] |= bit
+            else:
+                channel.members[key] &= ~bit
+        return True
+
+    def drop(self, channel):
+        # We left the channel
+        for channels in (self._channels, self._names):
+            old = channels.pop(self._key(channel), None)
+            if old is not None:
+                self._release(old)
+
+    def clear(self):
+        self._users.clear()
+        self._channels.clear()
+        self._names.clear()
+
+    def quit(self, nick):
+        # Returns the channels nick was in
+        key = self._key(nick)
+        if not key in self._users:
+            return []
+        return [channel.name for channel in self._channels.values()
+                if self._remove(channel, key)]
+
+    def rename(self, old, new):
+        old_key = self._key(old)
+        if not old_key in self._users:
+            return []
+        channels = []
+        for channel in self._channels.values():
+            if old_key in channel.members:
+                flags = channel.members[old_key]
+                self._remove(channel, old_key)
+                self._add(channel, new, flags)
+                channels.append(channel.name)
+        return channels
+
+    def names(self, channel, prefix = None):
+        # [nick, mode prefixes] sorted by nick, only those starting with
+        # prefix if it's given
+        channel = self._channels.get(self._key(channel))
+        if channel is None:
+            return []
+        if channel.keys is None:
+            channel.keys = sorted(channel.members.keys())
+
+        keys = channel.keys
+        if prefix:
+            if isinstance(prefix, unicode):
+                prefix = prefix.encode("utf-8")
+            prefix = prefix.lower()
+            start = bisect_left(keys, prefix)
+            end = start
+            while end < len(keys) and keys[end].startswith(prefix):
+                end += 1
+            keys = keys[start:end]
+        return [[self._users[key].nick, self._prefixes(channel.members[key])] for key in keys]
@@ -0,0 +1,254 @@
+# Schema migrations for the core database. Each entry upgrades the
+# database to its version number and they are applied in order, each in
+# its own transaction, when SQLiter opens db.sqlite.
+
+import sqlite3
+
+def _create_tables(conn):
+    conn.execute("""create table if not exists data (
+                      id integer primary key asc autoincrement,
+                      date double precision,
+                      network string,
+                      source string,
+                      channel string,
+                      line string)""")
+    conn.execute("""create table if not exists diffs (
+                      id integer primary key asc autoincrement,
+                      date double precision,
+                      cmd string,
+                      arg1 string,
+                      arg2 string,
+                      arg3 string,
+                      arg4 string,
+                      arg5 string)""")
+    conn.execute("""create table if not exists markers (
+                      id integer primary key asc autoincrement,
+                      date double precision,
+                      network string,
+                      channel string)""")
+
+def _add_indexes(conn):
+    conn.execute("""create index if not exists data_network_channel_date
+                    on data(network, channel, date)""")
+    conn.execute("""create index if not exists diffs_date on diffs(date)""")
+    conn.execute("""create index if not exists markers_network_channel
+                    on markers(network, channel)""")
+
+def _add_channel_catalog(conn):
+    conn.execute("""create table if not exists channels (
+                      network text,
+                      channel text,
+                      created double precision,
+                      last_activity double precision,
+                      lines integer,
+                      primary key (network, channel))""")
+    conn.execute("""insert or ignore into channels
+                    select network, channel, min(date), max(date), count(*)
+                    from data group by network, channel""")
+
+def _add_diff_line_reference(conn):
+    # ADD_LINE diffs point at their row in data instead of carrying a
+    # copy of the source and the message
+    conn.execute("""alter table diffs add column line_id integer""")
+
+def _add_meta(conn):
+    conn.execute("""create table if not exists meta (
+                      key text primary key,
+                      value)""")
+
+def _add_diff_filter_indexes(conn):
+    conn.execute("""create index if not exists diffs_network_channel
+                    on diffs(arg1, arg2, id)""")
+    conn.execute("""create index if not exists diffs_cmd on diffs(cmd, id)""")
+
+def _add_unread_counters(conn):
+    conn.execute("""alter table data add column highlight integer default 0""")
+    conn.execute("""alter table channels add column unread integer default 0""")
+    conn.execute("""alter table channels add column highlights integer default 0""")
+    conn.execute("""update channels set unread=
+                      (select count(*) from data
+                       where data.network=channels.network and data.channel=channels.channel
+                       and data.date>coalesce((select max(date) from markers
+                                               where markers.network=channels.network
+                                               and markers.channel=channels.channel), -1))""")
+
+def _add_mentions(conn):
+    conn.execute("""create table if not exists mentions (
+                      id integer primary key asc autoincrement,
+                      line_id integer,
+                      date double precision,
+                      network text,
+                      channel text,
+                      keyword text)""")
+    conn.execute("""create index if not exists mentions_network_channel
+                    on mentions(network, channel, date)""")
+    # Older highlights don't know which keyword matched
+    conn.execute("""insert into mentions(line_id,date,network,channel,keyword)
+                    select id, date, network, channel, null from data
+                    where highlight order by id""")
+
+def _add_archives(conn):
+    # Lines past the archive age live in one database per network and
+    # month, under datadir/archive
+    conn.execute("""create table if not exists archives (
+                      network text,
+                      month text,
+                      path text,
+                      first_date double precision,
+                      last_date double precision,
+                      lines integer,
+                      primary key (network, month))""")
+
+def _add_pending_deletes(conn):
+    # Closed channels whose lines, up to max_id, are still being deleted
+    conn.execute("""create table if not exists pending_deletes (
+                      id integer primary key asc autoincrement,
+                      network text,
+                      channel text,
+                      max_id integer)""")
+    conn.execute("""create index if not exists mentions_line on mentions(line_id)""")
+
+def _intern_strings(conn):
+    # Networks, channels and sources live once in strings, data and diffs
+    # keep their ids. In diffs arg1 and arg2, the network and the channel
+    # of every diff, are interned too.
+    conn.execute("""create table if not exists strings (
+                      id integer primary key asc autoincrement,
+                      value text unique)""")
+    conn.execute("""insert or ignore into strings(value)
+                    select network from data union select channel from data
+                    union select source from data
+                    union select arg1 from diffs union select arg2 from diffs""")
+    conn.execute("""delete from strings where value is null""")
+
+    # Ids are cursors and line references, the rebuilt tables have to go
+    # on counting from where the old ones were
+    sequences = dict(conn.execute("""select name, seq from sqlite_sequence
+                                     where name in ('data', 'diffs')""").fetchall())
+
+    conn.execute("""create table data_interned (
+                      id integer primary key asc autoincrement,
+                      date double precision,
+                      network_id integer,
+                      source_id integer,
+                      channel_id integer,
+                      line string,
+                      highlight integer default 0)""")
+    conn.execute("""insert into data_interned
+                    select d.id, d.date, n.id, s.id, c.id, d.line, d.highlight from data d
+                    left join strings n on n.value=d.network
+                    left join strings s on s.value=d.source
+                    left join strings c on c.value=d.channel""")
+    conn.execute("""drop table data""")
+    conn.execute("""alter table data_interned rename to data""")
+    conn.execute("""create index data_network_channel_date
+                    on data(network_id, channel_id, date)""")
+
+    conn.execute("""create table diffs_interned (
+                      id integer primary key asc autoincrement,
+                      date double precision,
+                      cmd string,
+                      arg1 integer,
+                      arg2 integer,
+                      arg3 string,
+                      arg4 string,
+                      arg5 string,
+                      line_id integer)""")
+    conn.execute("""insert into diffs_interned
+                    select d.id, d.date, d.cmd, n.id, c.id, d.arg3, d.arg4, d.arg5, d.line_id
+                    from diffs d
+                    left join strings n on n.value=d.arg1
+                    left join strings c on c.value=d.arg2""")
+    conn.execute("""drop table diffs""")
+    conn.execute("""alter table diffs_interned rename to diffs""")
+    conn.execute("""create index diffs_date on diffs(date)""")
+    conn.execute("""create index diffs_network_channel on diffs(arg1, arg2, id)""")
+    conn.execute("""create index diffs_cmd on diffs(cmd, id)""")
+
+    for name, seq in sequences.items():
+        row = conn.execute("""select seq from sqlite_sequence where name=?""",
+                           (name,)).fetchone()
+        conn.execute("""delete from sqlite_sequence where name=?""", (name,))
+        conn.execute("""insert into sqlite_sequence(name,seq) values (?,?)""",
+                     (name, max(seq, row and row[0] or 0)))
+
+MIGRATIONS = [(1, _create_tables),
+              (2, _add_indexes),
+              (3, _add_channel_catalog),
+              (4, _add_diff_line_reference),
+              (5, _add_meta),
+              (6, _add_diff_filter_indexes),
+              (7, _add_unread_counters),
+              (8, _add_mentions),
+              (9, _add_archives),
+              (10, _add_pending_deletes),
+              (11, _intern_strings)]
+
+def get_version(conn):
+    conn.execute("""create table if not exists schema_version (
+                      version integer primary key)""")
+    row = conn.execute("select max(version) from schema_version").fetchone()
+    return row[0] or 0
+
+def migrate(conn):
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        current = get_version(conn)
+        for version, migration in MIGRATIONS:
+            if version <= current:
+                continue
+            print "DB: Upgrading schema to version %d..." % (version,)
+            conn.execute("begin")
+            try:
+                migration(conn)
+                conn.execute("insert into schema_version(version) values (?)",
+                             (version,))
+            except:
+                conn.execute("rollback")
+                raise
+            conn.execute("commit")
+    finally:
+        conn.isolation_level = isolation_level
+
+def setup_vacuum(conn):
+    # Pruned pages go back to the file system a few at a time through
+    # incremental_vacuum, switching an existing database over needs one
+    # full vacuum
+    if conn.execute("pragma auto_vacuum").fetchone()[0] == 2:
+        return
+    print "DB: Enabling incremental vacuum..."
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute("pragma auto_vacuum=incremental")
+        conn.execute("vacuum")
+    finally:
+        conn.isolation_level = isolation_level
+
+def setup_fts(conn):
+    # The full text index is optional, sqlite builds without FTS5 simply
+    # run without search. Lines written before the index existed are
+    # indexed later by SQLiter.backfill_fts, everything above the
+    # fts_backfill_id watermark is already in it.
+    if conn.execute("""select 1 from sqlite_master
+                       where type='table' and name='data_fts'""").fetchone() is not None:
+        return True
+
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute("begin")
+        try:
+            conn.execute("""create virtual table data_fts
+                            using fts5(line, content='data', content_rowid='id')""")
+            conn.execute("""insert or replace into meta(key,value)
+                            select 'fts_backfill_id', coalesce(max(id), 0) from data""")
+        except sqlite3.OperationalError, e:
+            conn.execute("rollback")
+            print "DB: Full text search disabled (%s)" % (e,)
+            return False
+        conn.execute("commit")
+    finally:
+        conn.isolation_level = isolation_level
+    return True
@@ -1,51 +1,223 @@
 import sqlite3
+import threading
 import time
+import os
 from os import path
 from decimal import Decimal
 from diff_consts import Diff
+import schema
+
+# Page cursors point between two rows of a channel, they are handed to
+# clients as opaque "date:id" strings
+def make_cursor(date, row_id):
+    return "%r:%d" % (date, row_id)
+
+def parse_cursor(cursor):
+    date, row_id = cursor.split(":")
+    return float(date), int(row_id)
 
 class SQLiter(object):
-    def __init__(self, datadir = "datadir"):
+    # Column names in the lines tables: data keeps interned ids and the
+    # archives, which stand on their own, keep the strings
+    HOT = {"network": "network_id", "channel": "channel_id", "source": "source_id"}
+    ARCHIVED = {"network": "network", "channel": "channel", "source": "source"}
+
+    def __init__(self, datadir = "datadir", batch_size = 200, batch_delay = 0.05,
+                 read_pool_size = 3, synchronous = "normal", cache_size = -8000, mmap_size = 0):
         self._datadir = datadir
-        self._conn = sqlite3.connect(path.join(datadir, "db.sqlite"))
+        self._path = path.join(datadir, "db.sqlite")
+        # The writer connection is created here but used from the
+        # Storage writer thread, reads go through per thread read only
+        # connections, one for each of the read_pool_size reader threads
+        self._conn = sqlite3.connect(self._path, check_same_thread=False)
+        self._local = threading.local()
+        self._read_pool_size = read_pool_size
+        self._synchronous = synchronous
+        self._cache_size = cache_size
+        self._mmap_size = mmap_size
 
-        self._create()
+        # Lines and diffs are buffered and written in one transaction when
+        # batch_size rows are pending or batch_delay seconds have passed
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        self._pending_lines = []
+        self._pending_diffs = []
+        self._pending_mentions = []
+        self._pending_since = None
+        self._commit_listener = None
+
+        schema.migrate(self._conn)
+        schema.setup_vacuum(self._conn)
+        # With WAL readers work on the last committed state and never
+        # wait for the writer, nor the writer for them
+        self._conn.execute("pragma journal_mode=wal")
+        self._conn.execute("pragma synchronous=%s" % (self._synchronous,))
+        self._tune(self._conn)
+        self._fts = schema.setup_fts(self._conn)
+        self._load_strings()
 
     def __del__(self):
         print "Closing db..."
+        self.flush()
         self._conn.close()
 
-    def _create(self):
-        query = """create table if not exists data (
-                     id integer primary key asc autoincrement,
-                     date double precision,
-                     network string,
-                     source string,
-                     channel string,
-                     line string)"""
-
-        self._conn.execute(query)
-        query = """create table if not exists diffs (
-                     id integer primary key asc autoincrement,
-                     date double precision,
-                     cmd string,
-                     arg1 string,
-                     arg2 string,
-                     arg3 string,
-                     arg4 string,
-                     arg5 string)"""
-        self._conn.execute(query)
-        query = """create table if not exists markers (
-                     id integer primary key asc autoincrement,
-                     date double precision,
-                     network string,
-                     channel string)"""
-        self._conn.execute(query)
-        self._conn.commit()
+    def _get_commit_listener(self):
+        return self._commit_listener
+    def _set_commit_listener(self, listener):
+        self._commit_listener = listener
+    # Called from flush with the id of the last diff it committed
+    commit_listener = property(fget=_get_commit_listener, fset=_set_commit_listener)
+
+    def _get_read_pool_size(self):
+        return self._read_pool_size
+    read_pool_size = property(_get_read_pool_size)
+
+    def _get_fts(self):
+        return self._fts
+    # False when this sqlite has no FTS5 and search is unavailable
+    fts = property(_get_fts)
+
+    def _tune(self, conn):
+        conn.execute("pragma cache_size=%d" % (self._cache_size,))
+        conn.execute("pragma mmap_size=%d" % (self._mmap_size,))
+
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Readers manage their own transactions, see get_snapshot
+            conn = sqlite3.connect(self._path, isolation_level=None)
+            conn.execute("pragma query_only=1")
+            self._tune(conn)
+            self._local.conn = conn
+        return conn
+
+    def _load_strings(self):
+        # Interned strings never change, every thread resolves them from
+        # memory. Only the writer adds new ones, before it commits them.
+        ids = {}
+        strings = {}
+        for string_id, value in self._conn.execute("select id, value from strings"):
+            value = self._text(value)
+            ids[value] = string_id
+            strings[string_id] = value
+        self._ids = ids
+        self._strings = strings
+
+    def _text(self, value):
+        # The cache is keyed by unicode, whatever the caller passed or an
+        # older database stored
+        if isinstance(value, str):
+            return value.decode("utf-8")
+        if value is None:
+            return None
+        return unicode(value)
+
+    def _intern(self, value):
+        value = self._text(value)
+        string_id = self._ids.get(value)
+        if string_id is None:
+            cur = self._conn.execute("insert into strings(value) values (?)", (value,))
+            string_id = cur.lastrowid
+            self._strings[string_id] = value
+            self._ids[value] = string_id
+        return string_id
+
+    def _string_id(self, value):
+        # Strings that were never written match no rows
+        return self._ids.get(self._text(value), -1)
+
+    def _string(self, string_id):
+        return self._strings.get(string_id)
+
+    def _floor(self, conn, network, channel):
+        # The lines of a closed channel stay in data until prune gets to
+        # them, reads only see the ids above them
+        row = conn.execute("""select max(max_id) from pending_deletes
+                              where network=? and channel=?""", (network, channel)).fetchone()
+        return row[0] or 0
+
+    def _queued(self):
+        pending = len(self._pending_lines) + len(self._pending_diffs)
+        if self._pending_since is None:
+            self._pending_since = time.time()
+        if pending >= self._batch_size or self._batch_delay <= 0:
+            self.flush()
+
+    def flush_due(self):
+        if self._pending_since is None:
+            return None
+        return max(0, self._pending_since + self._batch_delay - time.time())
+
+    def flush(self):
+        self._pending_since = None
+        lines, self._pending_lines = self._pending_lines, []
+        diffs, self._pending_diffs = self._pending_diffs, []
+        mentions, self._pending_mentions = self._pending_mentions, []
+        if len(lines) == 0 and len(diffs) == 0:
+            return
+
+        try:
+            cur = self._conn.cursor()
+            line_ids = []
+            query = """insert into data(date,network_id,source_id,channel_id,line,highlight)
+                       values (?,?,?,?,?,?)"""
+            for date, network, source, channel, line, highlight in lines:
+                cur.execute(query, (date, self._intern(network), self._intern(source),
+                                    self._intern(channel), line, highlight))
+                line_ids.append(cur.lastrowid)
+            if self._fts:
+                query = """insert into data_fts(rowid,line) values (?,?)"""
+                self._conn.executemany(query, [(line_ids[i], lines[i][4])
+                                               for i in range(len(lines))])
+
+            rows = []
+            for diff in diffs:
+                line = diff[-1]
+                if line is not None:
+                    line = line_ids[line]
+                rows.append(diff[:2] + (self._intern(diff[2]), self._intern(diff[3])) +
+                            diff[4:-1] + (line,))
+            query = """insert into diffs(date,cmd,arg1,arg2,arg3,arg4,arg5,line_id)
+                       values (?,?,?,?,?,?,?,?)"""
+            self._conn.executemany(query, rows)
+            last_diff = self._conn.execute("select last_insert_rowid()").fetchone()[0]
+
+            # Mentions point at their line the same way ADD_LINE diffs do
+            query = """insert into mentions(line_id,date,network,channel,keyword)
+                       values (?,?,?,?,?)"""
+            self._conn.executemany(query, [(line_ids[mention[0]],) + mention[1:]
+                                           for mention in mentions])
+            self._update_catalog(lines)
+            self._conn.commit()
+        except:
+            self._conn.rollback()
+            # Strings interned by this batch are gone too
+            self._load_strings()
+            raise
+
+        if len(rows) > 0 and self._commit_listener is not None:
+            self._commit_listener(last_diff)
+
+    def _update_catalog(self, lines):
+        activity = {}
+        for date, network, source, channel, line, highlight in lines:
+            first, last, count, highlights = activity.get((network, channel), (date, date, 0, 0))
+            activity[(network, channel)] = (min(first, date), max(last, date),
+                                            count + 1, highlights + int(highlight))
+
+        for (network, channel), (first, last, count, highlights) in activity.items():
+            query = """insert or ignore into channels(network,channel,created,last_activity,lines)
+                       values (?,?,?,?,0)"""
+            self._conn.execute(query, (network, channel, first, last))
+            query = """update channels set last_activity=max(last_activity,?), lines=lines+?,
+                       unread=unread+?, highlights=highlights+?
+                       where network=? and channel=?"""
+            self._conn.execute(query, (last, count, count, highlights, network, channel))
 
     def mark(self, date, network, channel):
         query = """delete from markers where network=? and channel=?"""
 
+        self.flush()
         self._conn.execute(query, (network.decode("utf-8"),
                                    channel.decode("utf-8")))
 
@@ -55,13 +227,27 @@ class SQLiter(object):
                                    network.decode("utf-8"),
                                    channel.decode("utf-8")))
 
-        self._conn.commit()
+        # Unread counters restart from the new marker
+        query = """update channels set
+                     unread=(select count(*) from data
+                             where network_id=? and channel_id=? and date>?),
+                     highlights=(select count(*) from mentions
+                                 where network=? and channel=? and date>?)
+                   where network=? and channel=?"""
+        keys = (self._string_id(network), self._string_id(channel))
+        params = (network.decode("utf-8"), channel.decode("utf-8"))
+        self._conn.execute(query, keys + (date,) + params + (date,) + params)
+
         self.add_diff(time.time(), Diff.CHANGE_MARKER, network, channel, str(date))
+        self.flush()
 
     def get_mark(self, network, channel):
+        return self._get_mark(self._reader(), network, channel)
+
+    def _get_mark(self, conn, network, channel):
         query = """select date from markers where network=? and channel=?"""
 
-        cur = self._conn.cursor()
+        cur = conn.cursor()
         cur.execute(query, (network.decode("utf-8"),
                             channel.decode("utf-8")))
         mark = None
@@ -71,27 +257,133 @@ class SQLiter(object):
 
         return mark
 
+    def _get_meta(self, conn, key, default = None):
+        row = conn.execute("select value from meta where key=?", (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def _set_meta(self, key, value):
+        self._conn.execute("insert or replace into meta(key,value) values (?,?)",
+                           (key, value))
+
     def get_diffs(self, since):
-        query = """select distinct * from diffs where date > ?"""
+        conn = self._reader()
+        # Diffs older than the compaction horizon are gone, the client
+        # has to reload everything instead of replaying them
+        horizon = self._get_meta(conn, "diffs_horizon_date", 0)
+        if since < horizon:
+            row = conn.execute("select max(date) from diffs").fetchone()
+            return [], Decimal(row[0] or horizon), True
 
-        diffs = []
-        cur = self._conn.cursor()
-        cur.execute(query, (since,))
+        diffs = self._select_diffs(conn, "d.date > ?", (since,))
         now = Decimal(since)
+        for diff in diffs:
+            now = max(now, Decimal(diff[1]))
 
-        for row in cur:
-            now = max(now, Decimal(row[1]))
-            diffs.append(list(row))
+        return diffs, now, False
+
+    def get_changes(self, cursor, count = 1000, subscription = None):
+        conn = self._reader()
+        last = conn.execute("select max(id) from diffs").fetchone()[0] or 0
+        # A negative cursor starts from the current end of the log
+        if cursor < 0:
+            return [], last, False
+        horizon = self._get_meta(conn, "diffs_horizon_id", 0)
+        if cursor < horizon:
+            return [], last, True
+
+        where = "d.id > ? and d.id <= ?"
+        params = (cursor, last)
+        if subscription is not None:
+            where, params = self._subscription_filter(where, params, subscription)
+        diffs = self._select_diffs(conn, where, params, count)
+
+        # Short pages mean everything up to last was looked at, even the
+        # diffs that were filtered out
+        if len(diffs) < count:
+            cursor = last
+        else:
+            cursor = diffs[-1][0]
+        return diffs, cursor, False
+
+    def _subscription_filter(self, where, params, subscription):
+        networks = subscription.get("networks", [])
+        channels = subscription.get("channels", [])
+        cmds = subscription.get("cmds", [])
+
+        targets = []
+        if len(networks) > 0:
+            targets.append("d.arg1 in (%s)" % (",".join("?" * len(networks)),))
+            params += tuple([self._string_id(network) for network in networks])
+        for network, channel in channels:
+            targets.append("(d.arg1=? and d.arg2=?)")
+            params += (self._string_id(network), self._string_id(channel))
+        if len(targets) > 0:
+            where += " and (%s)" % (" or ".join(targets),)
 
-        return diffs, now
+        if len(cmds) > 0:
+            where += " and d.cmd in (%s)" % (",".join("?" * len(cmds)),)
+            params += tuple(cmds)
+        return where, params
+
+    def _select_diffs(self, conn, where, params, count = -1):
+        # ADD_LINE diffs reference their line in data, source and line are
+        # filled in from there. Lines deleted since then are skipped.
+        query = """select d.id, d.date, d.cmd, d.arg1, d.arg2, d.arg3,
+                          coalesce(l.line, d.arg4), d.arg5, l.source_id
+                   from diffs d left join data l on l.id=d.line_id
+                   where %s and (d.line_id is null or l.id is not null)
+                   order by d.id limit ?""" % (where,)
+
+        diffs = []
+        cur = conn.cursor()
+        cur.execute(query, params + (count,))
+        for diff_id, date, cmd, network, channel, arg3, arg4, arg5, source in cur:
+            if source is not None:
+                arg3 = self._string(source)
+            diffs.append([diff_id, date, cmd, self._string(network), self._string(channel),
+                          arg3, arg4, arg5])
+        return diffs
+
+    def compact_diffs(self, horizon):
+        self.flush()
+        cutoff = time.time() - horizon
+        try:
+            row = self._conn.execute("select max(id) from diffs where date < ?",
+                                     (cutoff,)).fetchone()
+            if row[0] is not None:
+                self._conn.execute("delete from diffs where date < ?", (cutoff,))
+                self._set_meta("diffs_horizon_date", cutoff)
+                self._set_meta("diffs_horizon_id", row[0])
+
+            # Only the newest marker of each channel matters
+            query = """delete from diffs where cmd=? and id not in
+                       (select max(id) from diffs where cmd=? group by arg1, arg2)"""
+            self._conn.execute(query, (Diff.CHANGE_MARKER, Diff.CHANGE_MARKER))
+
+            # Everything that happened to a channel before it was closed is
+            # folded into the CLOSE_CHANNEL diff
+            query = """select arg1, arg2, max(id) from diffs where cmd=?
+                       group by arg1, arg2"""
+            closes = self._conn.execute(query, (Diff.CLOSE_CHANNEL,)).fetchall()
+            query = """delete from diffs where arg1=? and arg2=? and id<? and cmd in (?,?,?)"""
+            for network, channel, close_id in closes:
+                self._conn.execute(query, (network, channel, close_id,
+                                           Diff.ADD_LINE, Diff.ADD_CHANNEL,
+                                           Diff.CHANGE_MARKER))
+            self._conn.commit()
+        except:
+            self._conn.rollback()
+            raise
 
     def get_networks(self):
-        query = """select distinct network from data"""
+        query = """select distinct network from channels order by created"""
 
         print "DB: Getting networks..."
 
         nets = []
-        cur = self._conn.cursor()
+        cur = self._reader().cursor()
         cur.execute(query)
 
         for row in cur:
@@ -100,10 +392,10 @@ class SQLiter(object):
         return nets
 
     def get_channels(self, network):
-        query = """select distinct channel from data where network=?"""
+        query = """select channel from channels where network=? order by created"""
 
         channs = []
-        cur = self._conn.cursor()
+        cur = self._reader().cursor()
         cur.execute(query, (network,))
 
         for row in cur:
@@ -113,49 +405,620 @@ class SQLiter(object):
 
     def get_lines(self, network, channel, offset, count, older_than = -1):
         if older_than == -1:
-            query = """select date, source, line from data where channel=? and network=?
-                       order by date desc limit ? offset ?"""
+            query = """select date, %(source)s, line from data where %(channel)s=? and %(network)s=?
+                       and id>? order by date desc limit ? offset ?"""
+            total = """select count(*) from data where %(channel)s=? and %(network)s=? and id>?"""
+            params = ()
         else:
-            query = """select date, source, line from data where channel=? and network=?
-                       and date>? order by date desc limit ? offset ?"""
+            query = """select date, %(source)s, line from data where %(channel)s=? and %(network)s=?
+                       and id>? and date>? order by date desc limit ? offset ?"""
+            total = """select count(*) from data where %(channel)s=? and %(network)s=? and id>?
+                       and date>?"""
+            params = (older_than,)
+        floor = self._floor(self._reader(), network, channel)
 
+        # The offset counts from the newest line, it goes through the hot
+        # table first and then through the archives, newest month first
         lines = []
-        cur = self._conn.cursor()
-        if older_than == -1:
-            cur.execute(query, (channel, network, count, offset))
+        skip = offset
+        for conn, columns, keys in self._sources(network, channel, after=older_than):
+            keys = (keys[1], keys[0], floor) + params
+            rows = [self._line(columns, row) for row in
+                    conn.execute(query % columns, keys + (count - len(lines), skip))]
+            lines += rows
+            if len(lines) >= count:
+                break
+            if len(rows) > 0:
+                skip = 0
+            else:
+                skip = max(0, skip - conn.execute(total % columns, keys).fetchone()[0])
+        return lines
+
+    def get_page(self, network, channel, cursor, count, older = True):
+        if older:
+            query = """select id, date, %(source)s, line from data where %(network)s=? and %(channel)s=?
+                       and id>? and date<=? and (date<? or id<?) order by date desc, id desc limit ?"""
+            start = (float("inf"), 0)
         else:
-            cur.execute(query, (channel, network, older_than, count, offset))
+            query = """select id, date, %(source)s, line from data where %(network)s=? and %(channel)s=?
+                       and id>? and date>=? and (date>? or id>?) order by date asc, id asc limit ?"""
+            start = (float("-inf"), 0)
+        if cursor:
+            start = parse_cursor(cursor)
 
-        for row in cur:
-            lines.append(list(row))
-        return lines
+        # Archived lines are all older than the ones in data, pages going
+        # back continue into the archives and pages going forward come
+        # out of them
+        if older:
+            sources = self._sources(network, channel, before=start[0])
+        else:
+            sources = self._sources(network, channel, after=start[0], newest_first=False)
+        floor = self._floor(self._reader(), network, channel)
+        rows = []
+        for conn, columns, keys in sources:
+            cur = conn.execute(query % columns, keys + (floor, start[0], start[0], start[1],
+                                                        count - len(rows)))
+            rows += [(row[0],) + tuple(self._line(columns, row[1:])) for row in cur]
+            if len(rows) >= count:
+                break
 
-    def add_line(self, date, network, channel, source, line):
-        query = """insert into data(date,network,source,channel,line) values (?,?,?,?,?)"""
+        # Keyset paging: the next page starts right after the last row of
+        # this one, going back the other way starts before the first row
+        next_cursor = None
+        prev_cursor = cursor or None
+        if len(rows) > 0:
+            prev_cursor = make_cursor(rows[0][1], rows[0][0])
+            if len(rows) == count:
+                next_cursor = make_cursor(rows[-1][1], rows[-1][0])
 
-        self._conn.execute(query, (date,
-                                   network.decode("utf-8"),
-                                   source.decode("utf-8"),
-                                   channel.decode("utf-8"),
-                                   line.decode("utf-8")))
-        self._conn.commit()
-        self.add_diff(date, Diff.ADD_LINE, network, channel, source, line)
+        if not older:
+            rows.reverse()
+        lines = [[date, source, line] for row_id, date, source, line in rows]
+        return lines, next_cursor, prev_cursor
+
+    def get_unread(self, network = None, channel = None, count = 400):
+        conn = self._reader()
+        query = """select c.network, c.channel, c.unread, c.highlights, max(m.date)
+                   from channels c left join markers m
+                   on m.network=c.network and m.channel=c.channel
+                   group by c.network, c.channel order by c.created"""
+        counts = [list(row) for row in conn.execute(query)]
+
+        lines = []
+        if network is not None and channel is not None:
+            mark = self._get_mark(conn, network, channel)
+            if mark is None:
+                mark = -1
+            query = """select date, source_id, line from data where channel_id=? and network_id=?
+                       and id>? and date>? order by date desc limit ?"""
+            params = (self._string_id(channel), self._string_id(network),
+                      self._floor(conn, network, channel), float(mark), count)
+            lines = [self._line(self.HOT, row) for row in conn.execute(query, params)]
+
+        return counts, lines
+
+    def get_snapshot(self, count):
+        conn = self._reader()
+        # One read transaction, so lines, markers and the diff cursor all
+        # come from the same state of the database
+        conn.execute("begin")
+        try:
+            networks = []
+            channels = {}
+            unread = {}
+            for network, channel, unread_count, highlights in \
+                    conn.execute("""select network, channel, unread, highlights
+                                    from channels order by created"""):
+                if not network in channels:
+                    networks.append(network)
+                    channels[network] = []
+                    unread[network] = {}
+                channels[network].append(channel)
+                unread[network][channel] = [unread_count, highlights]
+
+            markers = {}
+            for network, channel, date in conn.execute("""select network, channel, max(date)
+                                                          from markers group by network, channel"""):
+                markers.setdefault(network, {})[channel] = date
+
+            lines = {}
+            query = """select date, source_id, line from data where channel_id=? and network_id=?
+                       and id>? order by date desc limit ?"""
+            for network in channels:
+                lines[network] = {}
+                for channel in channels[network]:
+                    params = (self._string_id(channel), self._string_id(network),
+                              self._floor(conn, network, channel), count)
+                    lines[network][channel] = [self._line(self.HOT, row) for row in
+                                               conn.execute(query, params)]
+
+            cursor = conn.execute("select max(id) from diffs").fetchone()[0] or 0
+        finally:
+            conn.execute("commit")
+
+        return {"networks": networks,
+                "channels": channels,
+                "markers": markers,
+                "unread": unread,
+                "lines": lines,
+                "cursor": cursor}
+
+    def get_mentions(self, cursor = None, count = 50, network = None):
+        # Newest first, the cursor is the id of the last mention handed out
+        where = "1"
+        params = ()
+        if cursor:
+            where += " and m.id<?"
+            params += (cursor,)
+        if network is not None:
+            where += " and m.network=?"
+            params += (network,)
+        query = """select m.id, m.date, m.network, m.channel, l.source_id, l.line, m.keyword
+                   from mentions m join data l on l.id=m.line_id
+                   where %s order by m.id desc limit ?""" % (where,)
+
+        mentions = []
+        for row in self._reader().execute(query, params + (count,)):
+            row = list(row)
+            row[4] = self._string(row[4])
+            mentions.append(row)
+        next_cursor = None
+        if len(mentions) == count:
+            next_cursor = mentions[-1][0]
+        return mentions, next_cursor
+
+    def backfill_fts(self, chunk = 5000):
+        # Indexes the chunk lines right below the watermark, newest first,
+        # and returns how many older lines are still left to index
+        if not self._fts:
+            return 0
+        self.flush()
+        watermark = self._get_meta(self._conn, "fts_backfill_id", 0)
+        if watermark <= 0:
+            return 0
+        low = max(0, watermark - chunk)
+        try:
+            self._conn.execute("""insert into data_fts(rowid,line)
+                                  select id, line from data where id>? and id<=?""",
+                               (low, watermark))
+            self._set_meta("fts_backfill_id", low)
+            self._conn.commit()
+        except:
+            self._conn.rollback()
+            raise
+        return low
+
+    def _search_terms(self, query):
+        # Every word is matched as a quoted string, so user input never
+        # reaches the FTS5 query syntax
+        if isinstance(query, str):
+            query = query.decode("utf-8")
+        terms = query.split()
+        return " ".join(['"%s"' % (term.replace('"', '""'),) for term in terms])
+
+    def search(self, query, network = None, channel = None, cursor = None,
+               count = 50, context = 2):
+        terms = self._search_terms(query)
+        if not self._fts or terms == "":
+            return [], None
+
+        # Lines of closed channels that prune didn't get to yet
+        where = """data_fts match ? and not exists
+                   (select 1 from pending_deletes p
+                    join strings n on n.value=p.network join strings c on c.value=p.channel
+                    where n.id=d.network_id and c.id=d.channel_id and d.id<=p.max_id)"""
+        params = (terms,)
+        if network is not None:
+            where += " and d.network_id=?"
+            params += (self._string_id(network),)
+        if channel is not None:
+            where += " and d.channel_id=?"
+            params += (self._string_id(channel),)
+        offset = int(cursor or 0)
+
+        conn = self._reader()
+        query = """select d.id, d.date, d.network_id, d.channel_id, d.source_id, d.line
+                   from data_fts join data d on d.id=data_fts.rowid
+                   where %s order by bm25(data_fts), d.id desc
+                   limit ? offset ?""" % (where,)
+        rows = conn.execute(query, params + (count, offset)).fetchall()
+
+        before = """select date, source_id, line from data where network_id=? and channel_id=?
+                    and id>? and date<=? and (date<? or id<?) order by date desc, id desc limit ?"""
+        after = """select date, source_id, line from data where network_id=? and channel_id=?
+                   and date>=? and (date>? or id>?) order by date asc, id asc limit ?"""
+        hits = []
+        for row_id, date, network_id, channel_id, source_id, line in rows:
+            floor = self._floor(conn, self._string(network_id), self._string(channel_id))
+            params = (network_id, channel_id, date, date, row_id, context)
+            lines = [self._line(self.HOT, row) for row in
+                     conn.execute(before, params[:2] + (floor,) + params[2:])]
+            lines.reverse()
+            hits.append([row_id, date, self._string(network_id), self._string(channel_id),
+                         self._string(source_id), line, lines,
+                         [self._line(self.HOT, row) for row in conn.execute(after, params)]])
+
+        next_cursor = None
+        if len(hits) == count:
+            next_cursor = offset + count
+        return hits, next_cursor
+
+    def add_line(self, date, network, channel, source, line, mention = None):
+        self._add_line(date, network, channel, source, line, mention)
+        self._queued()
+
+    def add_lines(self, lines):
+        # (date, network, channel, source, line, mention) rows, all written
+        # in one transaction
+        for line in lines:
+            self._add_line(*line)
+        self.flush()
+
+    def _add_line(self, date, network, channel, source, line, mention = None):
+        self._pending_lines.append((date,
+                                    network.decode("utf-8"),
+                                    source.decode("utf-8"),
+                                    channel.decode("utf-8"),
+                                    line.decode("utf-8"),
+                                    mention is not None))
+        if mention is not None:
+            self._pending_mentions.append((len(self._pending_lines) - 1,
+                                           date,
+                                           network.decode("utf-8"),
+                                           channel.decode("utf-8"),
+                                           mention.decode("utf-8")))
+        self._pending_diffs.append((date,
+                                    Diff.ADD_LINE,
+                                    network.decode("utf-8"),
+                                    channel.decode("utf-8"),
+                                    None,
+                                    None,
+                                    u"",
+                                    len(self._pending_lines) - 1))
 
     def add_diff(self, date, cmd, arg1="", arg2="", arg3="", arg4="", arg5=""):
-        query = """insert into diffs(date,cmd,arg1,arg2,arg3,arg4,arg5) values (?,?,?,?,?,?,?)"""
+        self._pending_diffs.append((date,
+                                    cmd,
+                                    arg1.decode("utf-8"),
+                                    arg2.decode("utf-8"),
+                                    arg3.decode("utf-8"),
+                                    arg4.decode("utf-8"),
+                                    arg5.decode("utf-8"),
+                                    None))
+        self._queued()
 
-        self._conn.execute(query, (date,
-                                   cmd,
-                                   arg1.decode("utf-8"),
-                                   arg2.decode("utf-8"),
-                                   arg3.decode("utf-8"),
-                                   arg4.decode("utf-8"),
-                                   arg5.decode("utf-8")))
-        self._conn.commit()
+    def _archive_file(self, network, month):
+        name = "%s-%s.sqlite" % (network.replace(os.sep, "_"), month)
+        return path.join("archive", name)
 
-    def close(self, network, channel):
-        query = """delete from data where network=? and channel=?"""
+    def _archive_conn(self, archive_file):
+        archives = getattr(self._local, "archives", None)
+        if archives is None:
+            archives = {}
+            self._local.archives = archives
+        # Archives emptied by prune are removed, and may be written again
+        # later as a new file with the same name
+        try:
+            inode = os.stat(path.join(self._datadir, archive_file)).st_ino
+        except OSError:
+            return None
+        cached = archives.get(archive_file)
+        if cached is not None and cached[1] != inode:
+            cached[0].close()
+            cached = None
+        if cached is None:
+            conn = sqlite3.connect(path.join(self._datadir, archive_file),
+                                   isolation_level=None)
+            conn.execute("pragma query_only=1")
+            cached = (conn, inode)
+            archives[archive_file] = cached
+        return cached[0]
+
+    def _sources(self, network, channel, after = None, before = None, newest_first = True):
+        # The tables holding the lines of a channel, as reader connection,
+        # column names and the (network, channel) keys to look for: data
+        # first and then the archives that have lines between after and
+        # before
+        conn = self._reader()
+        query = """select path from archives where network=?
+                   and last_date>=coalesce(?, last_date)
+                   and first_date<=coalesce(?, first_date)
+                   order by month desc"""
+        archives = [row[0] for row in conn.execute(query, (network, after, before))]
+        hot = (conn, self.HOT, (self._string_id(network), self._string_id(channel)))
+        if newest_first:
+            yield hot
+        else:
+            archives.reverse()
+        for archive_file in archives:
+            conn = self._archive_conn(archive_file)
+            if conn is not None:
+                yield (conn, self.ARCHIVED, (network, channel))
+        if not newest_first:
+            yield hot
+
+    def _line(self, columns, row):
+        date, source, line = row
+        if columns is self.HOT:
+            source = self._string(source)
+        return [date, source, line]
+
+    def _write_archive(self, network, month, rows):
+        archive_file = self._archive_file(network, month)
+        archive_dir = path.join(self._datadir, "archive")
+        if not path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+
+        # Lines keep their ids, so moving the same lines twice after a
+        # crash doesn't duplicate them
+        conn = sqlite3.connect(path.join(self._datadir, archive_file))
+        try:
+            conn.execute("""create table if not exists data (
+                              id integer primary key,
+                              date double precision,
+                              network string,
+                              source string,
+                              channel string,
+                              line string,
+                              highlight integer)""")
+            conn.execute("""create index if not exists data_network_channel_date
+                            on data(network, channel, date)""")
+            conn.executemany("""insert or ignore into data(id,date,network,source,channel,line,highlight)
+                                values (?,?,?,?,?,?,?)""", rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+        dates = [row[1] for row in rows]
+        self._conn.execute("""insert or ignore into archives(network,month,path,first_date,last_date,lines)
+                              values (?,?,?,?,?,0)""",
+                           (network, month, archive_file, min(dates), max(dates)))
+        self._conn.execute("""update archives set first_date=min(first_date,?),
+                              last_date=max(last_date,?), lines=lines+?
+                              where network=? and month=?""",
+                           (min(dates), max(dates), len(rows), network, month))
+
+    def _drop_lines(self, ids, catalog = True):
+        # catalog is False for the lines of closed channels, which are no
+        # longer counted in channels
+        watermark = self._get_meta(self._conn, "fts_backfill_id", 0)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            if catalog:
+                for network_id, channel_id, lines in \
+                        self._conn.execute("""select network_id, channel_id, count(*) from data
+                                              where id in (%s) group by network_id, channel_id""" % (marks,),
+                                           chunk).fetchall():
+                    self._conn.execute("""update channels set lines=lines-?
+                                          where network=? and channel=?""",
+                                       (lines, self._string(network_id), self._string(channel_id)))
+            if self._fts:
+                # External content tables need the old text to drop a row,
+                # rows under the watermark were never indexed
+                self._conn.execute("""insert into data_fts(data_fts,rowid,line)
+                                      select 'delete', id, line from data
+                                      where id in (%s) and id>?""" % (marks,),
+                                   tuple(chunk) + (watermark,))
+            self._conn.execute("delete from mentions where line_id in (%s)" % (marks,), chunk)
+            self._conn.execute("delete from data where id in (%s)" % (marks,), chunk)
+
+    def _delete_archived(self, network, channel, where, params, limit, before = None):
+        # Deletes up to limit lines of channel matching where from the
+        # archives of network that start before before, oldest month
+        # first. Returns how many were deleted and the archive files left
+        # empty, which are dropped from the catalog and are for the caller
+        # to remove once it commits.
+        query = """select month, path from archives where network=?
+                   and first_date<=coalesce(?, first_date) order by month"""
+        deleted = 0
+        emptied = []
+        for month, archive_file in self._conn.execute(query, (network, before)).fetchall():
+            if deleted >= limit:
+                break
+            conn = sqlite3.connect(path.join(self._datadir, archive_file))
+            try:
+                ids = [row[0] for row in
+                       conn.execute("""select id from data where network=? and channel=? and %s
+                                       order by date, id limit ?""" % (where,),
+                                    (network, channel) + params + (limit - deleted,))]
+                if len(ids) > 0:
+                    conn.execute("delete from data where id in (%s)" % (",".join("?" * len(ids)),),
+                                 ids)
+                    conn.commit()
+            finally:
+                conn.close()
+            if len(ids) == 0:
+                continue
+
+            deleted += len(ids)
+            self._conn.execute("""update archives set lines=lines-? where network=? and month=?""",
+                               (len(ids), network, month))
+            lines = self._conn.execute("""select lines from archives where network=? and month=?""",
+                                       (network, month)).fetchone()[0]
+            if lines <= 0:
+                self._conn.execute("""delete from archives where network=? and month=?""",
+                                   (network, month))
+                emptied.append(archive_file)
+        return deleted, emptied
 
+    def _archived_bound(self, network, channel, floor, offset):
+        # (date, id) of the archived line of channel offset lines before
+        # its newest archived one, or None if there are not that many
+        query = """select date, id from data where network=? and channel=? and id>?
+                   order by date desc, id desc limit 1 offset ?"""
+        count = """select count(*) from
+                   (select 1 from data where network=? and channel=? and id>? limit ?)"""
+        for archive_file, in self._conn.execute("""select path from archives where network=?
+                                                   order by month desc""", (network,)).fetchall():
+            conn = sqlite3.connect(path.join(self._datadir, archive_file))
+            try:
+                row = conn.execute(query, (network, channel, floor, offset)).fetchone()
+                if row is None:
+                    offset -= conn.execute(count, (network, channel, floor, offset)).fetchone()[0]
+            finally:
+                conn.close()
+            if row is not None:
+                return tuple(row)
+        return None
+
+    def _remove_archives(self, archive_files):
+        for archive_file in archive_files:
+            try:
+                os.remove(path.join(self._datadir, archive_file))
+            except OSError:
+                pass
+
+    def archive(self, age, chunk = 5000):
+        # Moves up to chunk lines older than age seconds from data to the
+        # monthly archive of their network, returns how many were moved
+        self.flush()
+        cutoff = time.time() - age
+        query = """select id, date, source_id, line, highlight from data
+                   where network_id=? and channel_id=? and id>? and date<? order by date, id limit ?"""
+        moved = 0
+        for network, channel in self._conn.execute("""select network, channel
+                                                      from channels""").fetchall():
+            keys = (self._string_id(network), self._string_id(channel),
+                    self._floor(self._conn, network, channel))
+            rows = [(row_id, date, network, self._string(source_id), channel, line, highlight)
+                    for row_id, date, source_id, line, highlight in
+                    self._conn.execute(query, keys + (cutoff, chunk - moved))]
+            if len(rows) == 0:
+                continue
+
+            months = {}
+            for row in rows:
+                months.setdefault(time.strftime("%Y-%m", time.gmtime(row[1])), []).append(row)
+            try:
+                for month, month_rows in months.items():
+                    self._write_archive(network, month, month_rows)
+                self._drop_lines([row[0] for row in rows])
+                self._conn.commit()
+            except:
+                self._conn.rollback()
+                raise
+
+            moved += len(rows)
+            if moved >= chunk:
+                break
+        return moved
+
+    def backup(self):
+        # VACUUM INTO writes a consistent, compacted copy of db.sqlite from
+        # a read transaction, so the writer goes on meanwhile. It writes,
+        # as far as sqlite is concerned, so it can't use a query only
+        # reader connection.
+        backup_dir = path.join(self._datadir, "backup")
+        if not path.isdir(backup_dir):
+            os.makedirs(backup_dir)
+        backup_file = path.join(backup_dir,
+                                time.strftime("db-%Y%m%d-%H%M%S.sqlite", time.gmtime()))
+        conn = sqlite3.connect(self._path, isolation_level=None)
+        try:
+            conn.execute("vacuum into ?", (backup_file,))
+        finally:
+            conn.close()
+        return backup_file
+
+    def prune(self, retention, chunk = 500, vacuum_pages = 200):
+        # Deletes up to chunk lines, first from closed channels and then
+        # the oldest lines past the retention of each channel. retention
+        # maps (network, channel) to (max_age, max_lines), 0 is no limit.
+        # Returns how many lines were deleted.
+        self.flush()
+        closed = []
+        archived = 0
+        emptied = []
+        done = []
+        query = """select id from data where network_id=? and channel_id=? and id<=?
+                   order by id limit ?"""
+        for pending_id, network, channel, max_id in \
+                self._conn.execute("select id, network, channel, max_id from pending_deletes").fetchall():
+            keys = (self._string_id(network), self._string_id(channel))
+            rows = self._conn.execute(query, keys + (max_id, chunk - len(closed) - archived)).fetchall()
+            closed += [row[0] for row in rows]
+            if len(closed) + archived >= chunk:
+                break
+            # Then the lines of the channel that were archived
+            deleted, dropped = self._delete_archived(network, channel, "id<=?", (max_id,),
+                                                     chunk - len(closed) - archived)
+            archived += deleted
+            emptied += dropped
+            if len(closed) + archived >= chunk:
+                break
+            done.append(pending_id)
+
+        # Both limits drop the oldest lines first, so the lines to delete
+        # are those up to a (date, id) bound: the age cutoff or the newest
+        # line past max_lines, whichever is later. Archived lines are older
+        # than the ones in data, they count towards max_lines and go first.
+        now = time.time()
+        ids = []
+        bound_query = """select date, id from data where network_id=? and channel_id=? and id>?
+                         order by date desc, id desc limit 1 offset ?"""
+        count_query = """select count(*) from
+                         (select 1 from data where network_id=? and channel_id=? and id>? limit ?)"""
+        query = """select id from data where network_id=? and channel_id=? and id>?
+                   and date<=? and (date<? or id<=?) order by date, id limit ?"""
+        for network, channel in self._conn.execute("select network, channel from channels").fetchall():
+            if len(closed) + archived + len(ids) >= chunk:
+                break
+            max_age, max_lines = retention(network, channel)
+            bound = None
+            if max_age > 0:
+                bound = (now - max_age, 0)
+            keys = (self._string_id(network), self._string_id(channel),
+                    self._floor(self._conn, network, channel))
+            if max_lines > 0:
+                row = self._conn.execute(bound_query, keys + (max_lines,)).fetchone()
+                if row is None:
+                    hot = self._conn.execute(count_query, keys + (max_lines,)).fetchone()[0]
+                    row = self._archived_bound(network, channel, keys[2], max_lines - hot)
+                if row is not None and (bound is None or tuple(row) > bound):
+                    bound = tuple(row)
+            if bound is None:
+                continue
+            deleted, dropped = self._delete_archived(network, channel,
+                                                     "id>? and date<=? and (date<? or id<=?)",
+                                                     (keys[2], bound[0], bound[0], bound[1]),
+                                                     chunk - len(closed) - archived - len(ids),
+                                                     before=bound[0])
+            archived += deleted
+            emptied += dropped
+            if len(closed) + archived + len(ids) >= chunk:
+                break
+            rows = self._conn.execute(query, keys + (bound[0], bound[0], bound[1],
+                                                     chunk - len(closed) - archived - len(ids))).fetchall()
+            ids += [row[0] for row in rows]
+
+        if len(closed) + archived + len(ids) == 0 and len(done) == 0:
+            return 0
+        try:
+            self._drop_lines(closed, False)
+            self._drop_lines(ids)
+            for pending_id in done:
+                self._conn.execute("delete from pending_deletes where id=?", (pending_id,))
+            self._conn.commit()
+        except:
+            self._conn.rollback()
+            raise
+        self._remove_archives(emptied)
+        self._conn.execute("pragma incremental_vacuum(%d)" % (vacuum_pages,)).fetchall()
+        return len(closed) + archived + len(ids)
+
+    def close(self, network, channel):
+        self.flush()
+        # The lines, archived ones included, are deleted a batch at a time
+        # by prune, lines of a channel opened again with the same name are
+        # past max_id, the last id data ever handed out
+        row = self._conn.execute("""select seq from sqlite_sequence where name='data'""").fetchone()
+        if row is not None:
+            query = """insert into pending_deletes(network,channel,max_id) values (?,?,?)"""
+            self._conn.execute(query, (network, channel, row[0]))
+        query = """delete from mentions where network=? and channel=?"""
+        self._conn.execute(query, (network, channel))
+        query = """delete from channels where network=? and channel=?"""
         self._conn.execute(query, (network, channel))
         self.add_diff(time.time(), Diff.CLOSE_CHANNEL, network, channel)
-        self._conn.commit()
+        self.flush()
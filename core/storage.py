@@ -0,0 +1,280 @@
+import threading
+import Queue
+
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure, log
+from twisted.python.threadpool import ThreadPool
+
+from tailcache import TailCache, tail_slice
+
+# Deferred based front end for SQLiter: writes run in order on a single
+# writer thread, which also flushes SQLiter's batches, and reads run on a
+# small pool of reader threads against the last committed state. A read
+# doesn't wait for writes queued before it, callers that need to see a
+# write wait for its Deferred.
+class Storage(object):
+    def __init__(self, db, readers = None, cache = None):
+        self._db = db
+        self._db.commit_listener = self._committed
+        self._queue = Queue.Queue()
+        self._listeners = []
+
+        # add_line calls are numbered, the writer reports the last one it
+        # committed so the tail cache knows which lines a read can see
+        if cache is None:
+            cache = TailCache()
+        self._cache = cache
+        self._issued = 0
+        self._queued_seq = 0
+        self._committed_seq = 0
+        self._channel_seq = {}
+
+        self._writer = threading.Thread(target=self._write_loop,
+                                         name="RIRC DB writer")
+        self._writer.setDaemon(True)
+        self._writer.start()
+
+        if readers is None:
+            readers = self._db.read_pool_size
+        self._readers = ThreadPool(1, readers, "RIRC DB readers")
+        self._readers.start()
+
+    def _write_loop(self):
+        while True:
+            timeout = self._db.flush_due()
+            try:
+                if timeout is None:
+                    d, f, args, kwargs = self._queue.get()
+                else:
+                    d, f, args, kwargs = self._queue.get(True, timeout)
+            except Queue.Empty:
+                self._run(None, self._db.flush)
+                continue
+
+            if f is None:
+                self._run(d, self._db.flush)
+                return
+            self._run(d, f, *args, **kwargs)
+
+    def _run(self, d, f, *args, **kwargs):
+        try:
+            result = f(*args, **kwargs)
+        except:
+            result = failure.Failure()
+            if d is None:
+                reactor.callFromThread(log.err, result)
+                return
+            reactor.callFromThread(d.errback, result)
+        else:
+            if d is not None:
+                reactor.callFromThread(d.callback, result)
+
+    def _write(self, f, *args, **kwargs):
+        d = defer.Deferred()
+        self._queue.put((d, f, args, kwargs))
+        return d
+
+    def _read(self, f, *args, **kwargs):
+        return threads.deferToThreadPool(reactor, self._readers, f, *args, **kwargs)
+
+    def _committed(self, last_diff):
+        reactor.callFromThread(self._notify, last_diff, self._queued_seq)
+
+    def _notify(self, last_diff, seq):
+        self._committed_seq = seq
+        for listener in self._listeners[:]:
+            listener(last_diff)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _get_fts(self):
+        return self._db.fts
+    fts = property(_get_fts)
+
+    def stop(self):
+        d = defer.Deferred()
+        self._queue.put((d, None, (), {}))
+        d.addBoth(lambda result: self._readers.stop() or result)
+        return d
+
+    def flush(self):
+        return self._write(self._db.flush)
+
+    def mark(self, date, network, channel):
+        return self._write(self._db.mark, date, network, channel)
+
+    def get_mark(self, network, channel):
+        return self._read(self._db.get_mark, network, channel)
+
+    def get_diffs(self, since):
+        return self._read(self._db.get_diffs, since)
+
+    def get_changes(self, cursor, count = 1000, subscription = None):
+        return self._read(self._db.get_changes, cursor, count, subscription)
+
+    def wait_changes(self, cursor, timeout, count = 1000, subscription = None):
+        # Long poll: fires as soon as there are changes after cursor, or
+        # with an empty list once timeout seconds have passed
+        if cursor < 0:
+            return self.get_changes(cursor, count, subscription)
+
+        def _cancel(result):
+            # The client went away
+            self.remove_listener(_committed)
+            if timer.active():
+                timer.cancel()
+        result = defer.Deferred(_cancel)
+
+        def _finish(changes):
+            if result.called:
+                return
+            self.remove_listener(_committed)
+            if timer.active():
+                timer.cancel()
+            result.callback(changes)
+
+        def _fail(reason):
+            if result.called:
+                return
+            self.remove_listener(_committed)
+            if timer.active():
+                timer.cancel()
+            result.errback(reason)
+
+        def _checked(changes):
+            diffs, next_cursor, resync = changes
+            if len(diffs) > 0 or resync:
+                _finish(changes)
+
+        def _check():
+            d = self.get_changes(cursor, count, subscription)
+            d.addCallbacks(_checked, _fail)
+
+        def _committed(last_diff):
+            if last_diff > cursor:
+                _check()
+
+        timer = reactor.callLater(timeout, _finish, ([], cursor, False))
+        self.add_listener(_committed)
+        _check()
+        return result
+
+    def compact_diffs(self, horizon):
+        return self._write(self._db.compact_diffs, horizon)
+
+    def archive(self, age, chunk = 5000):
+        return self._write(self._db.archive, age, chunk)
+
+    def prune(self, retention, chunk = 500):
+        def _pruned(deleted):
+            if deleted > 0:
+                self._cache.clear()
+            return deleted
+        return self._write(self._db.prune, retention, chunk).addCallback(_pruned)
+
+    def backup(self):
+        return self._read(self._db.backup)
+
+    def get_networks(self):
+        return self._read(self._db.get_networks)
+
+    def get_channels(self, network):
+        return self._read(self._db.get_channels, network)
+
+    def get_lines(self, network, channel, offset, count, older_than = -1):
+        # Pages past the tail of the channel always go to the database
+        if not self._cache.enabled or offset + count > self._cache.lines:
+            if self._cache.enabled:
+                self._cache.miss()
+            return self._read(self._db.get_lines, network, channel,
+                              offset, count, older_than)
+
+        key = self._cache.key(network, channel)
+        lines = self._cache.get(key, offset, count, older_than)
+        if lines is not None:
+            return defer.succeed(lines)
+
+        # Lines still on their way to the database would be missing from
+        # what the read returns, it only fills the cache if there are none
+        # and none arrive while it runs
+        version = self._cache.version(key)
+        fill = self._channel_seq.get(key, 0) <= self._committed_seq
+        def _tail(newest):
+            if fill:
+                self._cache.fill(key, version, newest)
+            lines = tail_slice(newest, len(newest) < self._cache.lines,
+                               offset, count, older_than)
+            if lines is not None:
+                return lines
+            return self._read(self._db.get_lines, network, channel,
+                              offset, count, older_than)
+        d = self._read(self._db.get_lines, network, channel, 0, self._cache.lines)
+        return d.addCallback(_tail)
+
+    def get_page(self, network, channel, cursor, count, older = True):
+        return self._read(self._db.get_page, network, channel, cursor, count, older)
+
+    def get_snapshot(self, count):
+        return self._read(self._db.get_snapshot, count)
+
+    def get_unread(self, network = None, channel = None, count = 400):
+        return self._read(self._db.get_unread, network, channel, count)
+
+    def get_mentions(self, cursor = None, count = 50, network = None):
+        return self._read(self._db.get_mentions, cursor, count, network)
+
+    def search(self, query, network = None, channel = None, cursor = None, count = 50):
+        return self._read(self._db.search, query, network, channel, cursor, count)
+
+    def backfill_fts(self, chunk = 5000):
+        return self._write(self._db.backfill_fts, chunk)
+
+    def _issue(self, date, network, channel, source, line):
+        key = self._cache.key(network, channel)
+        self._issued += 1
+        self._channel_seq[key] = self._issued
+        self._cache.append(key, [date, source.decode("utf-8"), line.decode("utf-8")])
+        return self._issued
+
+    def add_line(self, date, network, channel, source, line, mention = None):
+        seq = self._issue(date, network, channel, source, line)
+        return self._write(self._add_line, seq,
+                           date, network, channel, source, line, mention)
+
+    def _add_line(self, seq, *args):
+        # add_line may commit right away, the line is part of that commit
+        self._queued_seq = seq
+        self._db.add_line(*args)
+
+    def add_lines(self, lines):
+        # (date, network, channel, source, line, mention) rows, committed
+        # together
+        seq = self._issued
+        for line in lines:
+            seq = self._issue(*line[:5])
+        return self._write(self._add_lines, seq, lines)
+
+    def _add_lines(self, seq, lines):
+        self._queued_seq = seq
+        self._db.add_lines(lines)
+
+    def get_cache_stats(self):
+        return self._cache.stats()
+
+    def add_diff(self, date, cmd, arg1="", arg2="", arg3="", arg4="", arg5=""):
+        return self._write(self._db.add_diff, date, cmd, arg1, arg2, arg3, arg4, arg5)
+
+    def close(self, network, channel):
+        # Reads running until the close is committed may still fill the
+        # cache with the old lines, the entry is dropped again after it
+        key = self._cache.key(network, channel)
+        def _closed(result):
+            self._cache.invalidate(key)
+            return result
+        self._cache.invalidate(key)
+        return self._write(self._db.close, network, channel).addBoth(_closed)
@@ -0,0 +1,114 @@
+from twisted.web import resource, server, xmlrpc
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from compression import StreamCompressor
+
+try:
+    import simplejson as json
+except ImportError, e:
+    import json
+
+# Pushes diffs to a client over a single chunked HTTP response, one JSON
+# object per line with the same fields get_changes returns. Clients
+# resume after a reconnect by passing the last cursor they got:
+#
+#   GET /stream?cursor=1234&subscription=<id from subscribe>
+class DiffStream(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, rpc, db):
+        resource.Resource.__init__(self)
+        self._rpc = rpc
+        self._db = db
+
+    def render_GET(self, request):
+        error = self._rpc.check_auth(request)
+        if error is not None:
+            return error
+
+        try:
+            cursor = int(request.args.get("cursor", ["-1"])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            return "Invalid cursor"
+        try:
+            subscription = self._rpc.get_subscription(request.args.get("subscription", [None])[0])
+        except xmlrpc.Fault, f:
+            request.setResponseCode(404)
+            return f.faultString
+
+        request.setHeader("content-type", "application/json")
+        StreamSubscriber(request, self._db, cursor, subscription).start()
+        return server.NOT_DONE_YET
+
+class StreamSubscriber(object):
+    PAGE = 500
+    KEEPALIVE = 30
+
+    def __init__(self, request, db, cursor, subscription = None):
+        self._request = request
+        self._db = db
+        self._cursor = cursor
+        self._subscription = subscription
+        self._finished = False
+        self._busy = False
+        self._again = False
+        self._greeted = False
+        self._keepalive = LoopingCall(self._ping)
+        self._compressor = StreamCompressor(request)
+
+    def start(self):
+        self._db.add_listener(self._committed)
+        self._request.notifyFinish().addBoth(self._stop)
+        self._keepalive.start(self.KEEPALIVE, now=False)
+        self._pump()
+
+    def _stop(self, _):
+        self._finished = True
+        self._db.remove_listener(self._committed)
+        if self._keepalive.running:
+            self._keepalive.stop()
+
+    def _write(self, data):
+        self._request.write(self._compressor.compress(data))
+
+    def _ping(self):
+        self._write("\n")
+
+    def _committed(self, last_diff):
+        if last_diff > self._cursor:
+            self._pump()
+
+    def _pump(self):
+        # Only one read in flight, commits seen meanwhile trigger another
+        if self._busy:
+            self._again = True
+            return
+        self._busy = True
+        self._again = False
+        d = self._db.get_changes(self._cursor, self.PAGE, self._subscription)
+        d.addCallbacks(self._got, self._failed)
+
+    def _got(self, result):
+        self._busy = False
+        if self._finished:
+            return
+
+        # The first page is always sent, even empty, so the client gets
+        # the response headers and its starting cursor right away
+        changes, next_cursor, resync = result
+        if len(changes) > 0 or resync or not self._greeted:
+            self._greeted = True
+            self._write(json.dumps({"changes": changes,
+                                    "next_cursor": next_cursor,
+                                    "resync": resync}) + "\n")
+        self._cursor = next_cursor
+        if self._again or len(changes) == self.PAGE:
+            self._pump()
+
+    def _failed(self, reason):
+        self._busy = False
+        log.err(reason)
+        if not self._finished:
+            self._request.finish()
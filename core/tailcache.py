@@ -0,0 +1,122 @@
+from collections import deque, OrderedDict
+
+def tail_slice(lines, complete, offset, count, older_than = -1):
+    # Answers get_lines from the newest lines of a channel, newest first,
+    # or returns None if the answer may need older lines than these.
+    # complete means there are no older lines.
+    newer = lines
+    if older_than != -1:
+        newer = [line for line in lines if line[0] > older_than]
+    if complete or offset + count <= len(newer) or \
+            (older_than != -1 and len(lines) > 0 and lines[-1][0] <= older_than):
+        return newer[offset:offset + count]
+    return None
+
+# Newest lines of the channels clients read last, newest line at the right
+# of each deque. Lives on the reactor thread, next to Storage.
+#
+# Every append, invalidation and clear bumps the version of a channel, a
+# read from the database may only fill the cache if the version didn't
+# change while it was running.
+class TailCache(object):
+    def __init__(self, lines = 400, max_lines = 50000):
+        self._lines = lines
+        self._max_lines = max_lines
+        self._entries = OrderedDict()
+        self._complete = {}
+        self._versions = {}
+        self._generation = 0
+        self._total = 0
+        self._hits = 0
+        self._misses = 0
+
+    def _get_lines(self):
+        return self._lines
+    lines = property(_get_lines)
+
+    def _get_enabled(self):
+        return self._lines > 0 and self._max_lines > 0
+    enabled = property(_get_enabled)
+
+    def key(self, network, channel):
+        if isinstance(network, str):
+            network = network.decode("utf-8")
+        if isinstance(channel, str):
+            channel = channel.decode("utf-8")
+        return (network, channel)
+
+    def version(self, key):
+        return (self._generation, self._versions.get(key, 0))
+
+    def miss(self):
+        self._misses += 1
+
+    def get(self, key, offset, count, older_than = -1):
+        # The lines newest first, like SQLiter.get_lines, or None when the
+        # cache can't tell
+        entry = self._entries.get(key)
+        if entry is None:
+            self._misses += 1
+            return None
+
+        lines = tail_slice(list(reversed(entry)), self._complete[key],
+                           offset, count, older_than)
+        if lines is None:
+            self._misses += 1
+            return None
+
+        self._hits += 1
+        self._entries[key] = self._entries.pop(key)
+        return lines
+
+    def fill(self, key, version, lines):
+        # lines are the newest self._lines lines of the channel, newest
+        # first, read while the channel was at version
+        if not self.enabled or version != self.version(key):
+            return
+        self.invalidate(key)
+        entry = deque(reversed(lines), self._lines)
+        self._entries[key] = entry
+        self._complete[key] = len(lines) < self._lines
+        self._total += len(entry)
+        self._evict()
+
+    def append(self, key, line):
+        self._versions[key] = self._versions.get(key, 0) + 1
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        if len(entry) == self._lines:
+            self._complete[key] = False
+        else:
+            self._total += 1
+        entry.append(line)
+        self._evict()
+
+    def invalidate(self, key):
+        self._versions[key] = self._versions.get(key, 0) + 1
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total -= len(entry)
+            del self._complete[key]
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+        self._complete.clear()
+        self._total = 0
+
+    def _evict(self):
+        # Least recently read channels go first
+        while self._total > self._max_lines and len(self._entries) > 0:
+            key, entry = self._entries.popitem(last=False)
+            self._total -= len(entry)
+            del self._complete[key]
+
+    def stats(self):
+        return {"hits": self._hits,
+                "misses": self._misses,
+                "channels": len(self._entries),
+                "lines": self._total,
+                "max_lines": self._max_lines,
+                "lines_per_channel": self._lines}
@@ -4,6 +4,8 @@ import xmlrpclib
 from twisted.web import xmlrpc, server, http
 from twisted.internet import defer, protocol, reactor
 
+from compression import compress
+
 Fault = xmlrpclib.Fault
 
 class XmlRpcAuth(xmlrpc.XMLRPC):
@@ -13,7 +15,15 @@ class XmlRpcAuth(xmlrpc.XMLRPC):
         self._auth = (self._user !='')
         xmlrpc.XMLRPC.__init__(self, allowNone=True)
 
-    def render(self, request):
+    def find_function(self, functionPath):
+        if hasattr(self, "_getFunction"):
+            return self._getFunction(functionPath)
+        return self.lookupProcedure(functionPath)
+
+    def encode_result(self, result):
+        return result
+
+    def check_auth(self, request):
         if self._auth:
             cleartext_token = self._user + ':' + self._password
             user = request.getUser()
@@ -27,22 +37,61 @@ class XmlRpcAuth(xmlrpc.XMLRPC):
                 if token != cleartext_token:
                     request.setResponseCode(http.UNAUTHORIZED)
                     return 'Authorization Failed!'
+        return None
+
+    def render(self, request):
+        error = self.check_auth(request)
+        if error is not None:
+            return error
 
         request.content.seek(0, 0)
         args, functionPath = xmlrpclib.loads(request.content.read())
         try:
-            if hasattr(self, "_getFunction"):
-                function = self._getFunction(functionPath)
-            else:
-                function = self.lookupProcedure(functionPath)
+            function = self.find_function(functionPath)
         except Fault, f:
             self._cbRender(f, request)
         else:
             request.setHeader("content-type", "text/xml")
-            defer.maybeDeferred(function, *args).addErrback(
+            # A client that goes away cancels its call, long polls stop
+            # waiting and nothing is written to the dead connection
+            responseFailed = []
+            d = defer.maybeDeferred(function, *args)
+            request.notifyFinish().addErrback(self._responseFailed, d, responseFailed)
+            d.addCallback(
+                self.encode_result
+                ).addErrback(
                 self._ebRender
                 ).addCallback(
-                self._cbRender, request
+                self._cbRender, request, responseFailed
                 )
 
         return server.NOT_DONE_YET
+
+    def _responseFailed(self, reason, d, responseFailed):
+        responseFailed.append(reason)
+        d.cancel()
+
+    def _ebRender(self, failure):
+        if failure.check(defer.CancelledError):
+            return None
+        return xmlrpc.XMLRPC._ebRender(self, failure)
+
+    def _cbRender(self, result, request, responseFailed = None):
+        if responseFailed:
+            return
+        if not isinstance(result, Fault):
+            result = (result,)
+        try:
+            content = xmlrpclib.dumps(result, methodresponse=True,
+                                      allow_none=self.allowNone)
+        except Exception, e:
+            f = Fault(self.FAILURE, "Can't serialize output: %s" % (e,))
+            content = xmlrpclib.dumps(f, methodresponse=True,
+                                      allow_none=self.allowNone)
+        if isinstance(content, unicode):
+            content = content.encode("utf-8")
+
+        content = compress(request, content)
+        request.setHeader("content-length", str(len(content)))
+        request.write(content)
+        request.finish()